@@ -0,0 +1,375 @@
+"""
+automatch.py
+Matching engine for auto-responses. Keeps each server's regexes compiled, and indexes the literal text each one requires in an Aho-Corasick automaton,
+so that a message only has to be scanned once to find which regexes could match it. Only those regexes are then actually run,
+in worker processes (see RegexPool) which are killed if they take too long.
+"""
+
+import asyncio
+import multiprocessing
+import re
+import string
+
+try:
+	from re import _parser as sre_parse
+except ImportError:
+	import sre_parse
+
+
+# Repeats which have to match at least once still require the literals in their body
+REPEATS = tuple(getattr(sre_parse, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') if hasattr(sre_parse, name))
+# Zero-width assertions, which do not separate the literal characters on either side of them
+ZERO_WIDTH = (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT)
+
+def _casefold_fixes():
+	"""Returns a translation table mapping each non-ASCII character which re matches against an ASCII letter under IGNORECASE,
+	but which str.casefold() does not turn into exactly that letter, to the letter (e.g. 'ı' and 'İ' to 'i').
+	Only characters in the Basic Multilingual Plane which have a case are checked, since no others can match an ASCII letter."""
+	text = "".join(ch for ch in map(chr, range(128, 0x10000)) if ch.lower() != ch.upper())
+	return str.maketrans({ch: letter for letter in string.ascii_lowercase for ch in re.findall('(?i)' + letter, text) if ch.casefold() != letter})
+
+
+CASEFOLD_FIXES = _casefold_fixes()
+
+
+def casefold(text):
+	"""Folds text so that any ASCII literal which a regex (even one using IGNORECASE) matches in text also appears in casefold(text) as literal.casefold().
+	The fixes are applied first, since casefold() turns some of those characters into several (e.g. 'İ' into 'i' and a combining dot)."""
+	return text.translate(CASEFOLD_FIXES).casefold()
+
+
+def _literal_runs(items):
+	"""Returns a list of all runs of literal characters which any string matching the parsed regex items must contain."""
+	runs = []
+	run = []
+	for op, av in items:
+		if op is sre_parse.LITERAL:
+			run.append(chr(av))
+			continue
+		if op in ZERO_WIDTH:
+			continue
+		runs.append("".join(run))
+		run = []
+		if op is sre_parse.SUBPATTERN:
+			runs.extend(_literal_runs(av[-1]))
+		elif op in REPEATS and av[0] >= 1:
+			runs.extend(_literal_runs(av[2]))
+	runs.append("".join(run))
+	return runs
+
+
+def _has_nested_repeat(items, in_repeat=False):
+	"""Returns True if the parsed regex items contain an unbounded repeat inside another repeat (or in_repeat is set and they contain any unbounded repeat)."""
+	for op, av in items:
+		if op in REPEATS:
+			if in_repeat and av[1] == sre_parse.MAXREPEAT:
+				return True
+			if _has_nested_repeat(av[2], in_repeat or av[1] > 1):
+				return True
+		elif op is sre_parse.SUBPATTERN:
+			if _has_nested_repeat(av[-1], in_repeat):
+				return True
+		elif op is sre_parse.BRANCH:
+			if any(_has_nested_repeat(branch, in_repeat) for branch in av[1]):
+				return True
+		elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+			if _has_nested_repeat(av[1], in_repeat):
+				return True
+	return False
+
+
+def is_pathological(regex):
+	"""Returns True if regex nests an unbounded repeat inside another repeat, e.g. (a+)+ or (\\w*\\s?)*.
+	Regexes like these can take exponential time to fail to match, so they should not be accepted from users."""
+	try:
+		return _has_nested_repeat(sre_parse.parse(regex).data)
+	except re.error:
+		return False
+
+
+def required_literal(regex):
+	"""Returns the longest run of ASCII text which every match of regex must contain, or None if there isn't one (or it can't be determined).
+	EXAMPLE: required_literal(r"(?i)\\bjoker\\b") is "joker"."""
+	try:
+		parsed = sre_parse.parse(regex)
+	except re.error:
+		return None
+	if parsed.state.flags & re.LOCALE:
+		return None
+	candidates = []
+	for run in _literal_runs(parsed.data):
+		# Non-ASCII characters may be matched case-insensitively in ways casefold() does not cover, so only keep the ASCII parts
+		candidates.extend(re.findall(r'[\x00-\x7f]+', run))
+	return max(candidates, key=len, default=None)
+
+
+class LiteralAutomaton:
+	"""
+	Aho-Corasick automaton over a set of literal strings. Finds every literal that occurs in a text in a single pass over it.
+	"""
+	def __init__(self, literals):
+		"""Initialize the LiteralAutomaton. literals is a dict of literal strings to lists of ids which are reported when that literal is found."""
+		# Build the trie
+		goto = [{}]
+		self.outputs = [set()]
+		for literal, ids in literals.items():
+			state = 0
+			for ch in literal:
+				if ch not in goto[state]:
+					goto[state][ch] = len(goto)
+					goto.append({})
+					self.outputs.append(set())
+				state = goto[state][ch]
+			self.outputs[state].update(ids)
+
+		# Compute failure links breadth first, and turn the trie into a DFA so that scanning never has to follow them
+		self.transitions = [dict(goto[0])]
+		self.transitions.extend({} for _ in range(len(goto) - 1))
+		fail = [0] * len(goto)
+		queue = list(goto[0].values())
+		for state in queue:
+			self.transitions[state] = dict(self.transitions[fail[state]])
+			self.transitions[state].update(goto[state])
+			self.outputs[state] |= self.outputs[fail[state]]
+			for ch, child in goto[state].items():
+				fail[child] = self.transitions[fail[state]].get(ch, 0)
+				queue.append(child)
+
+	def search(self, text):
+		"""Returns the set of ids of all literals which occur in text."""
+		found = set()
+		transitions = self.transitions
+		outputs = self.outputs
+		state = 0
+		for ch in text:
+			state = transitions[state].get(ch, 0)
+			if outputs[state]:
+				found |= outputs[state]
+		return found
+
+
+class RuleMatcher:
+	"""
+	Holds the compiled regexes of one server's auto-responses. Build a new one whenever that server's set of regexes changes.
+	"""
+	def __init__(self, regexes):
+		"""Initialize the RuleMatcher, compiling every regex in regexes. Regexes which fail to compile are skipped, since they can never match."""
+		self.rules = []
+		self.indices = {}
+		# Rules which should not be run at the moment, e.g. because they are in their cooldown period
+		self.inactive = set()
+		literals = {}
+		# Rules with no required literal, which have to be run on every message
+		self.unfiltered = set()
+		for regex in regexes:
+			try:
+				pattern = re.compile(regex)
+			except re.error:
+				continue
+			literal = required_literal(regex)
+			if literal:
+				literals.setdefault(casefold(literal), []).append(len(self.rules))
+			else:
+				self.unfiltered.add(len(self.rules))
+			self.indices[regex] = len(self.rules)
+			self.rules.append((regex, pattern))
+		self.automaton = LiteralAutomaton(literals) if literals else None
+
+	def __len__(self):
+		return len(self.rules)
+
+	def deactivate(self, regex):
+		"""Stops regex from being run until activate() is called."""
+		if regex in self.indices:
+			self.inactive.add(self.indices[regex])
+
+	def activate(self, regex):
+		"""Allows regex to be run again after deactivate()."""
+		if regex in self.indices:
+			self.inactive.discard(self.indices[regex])
+
+	def candidates(self, content):
+		"""Returns the indices (into self.rules) of the active rules which could match content, based on the literals they require."""
+		if self.automaton is None:
+			candidates = self.unfiltered
+		else:
+			candidates = self.unfiltered | self.automaton.search(casefold(content))
+		return candidates - self.inactive if self.inactive else candidates
+
+	def candidate_regexes(self, content):
+		"""Returns a list of the regexes (as their original strings) which could match content, in the order they were given."""
+		return [self.rules[i][0] for i in sorted(self.candidates(content))]
+
+	def match(self, content):
+		"""Returns a list of every regex (as its' original string) that matches somewhere in content, in the order they were given.
+		This runs the regexes in the current process, with no time limit; see RegexPool for that."""
+		out = []
+		for i in sorted(self.candidates(content)):
+			regex, pattern = self.rules[i]
+			if pattern.search(content):
+				out.append(regex)
+		return out
+
+
+def _worker_main(conn, progress):
+	"""Entry point of RegexPool worker processes. Receives (regexes, content) requests over conn, sends the index of each regex that matches as soon as it does,
+	then None once every regex has been run. The index of the regex currently being run is kept in progress, so that a worker which is taking too long
+	can be blamed on it. Regexes are all compiled before any are run, so that compiling them is never blamed on whichever regex is running."""
+	compiled = {}
+	conn.send(None)
+	while True:
+		try:
+			regexes, content = conn.recv()
+		except EOFError:
+			return
+		if len(compiled) + len(regexes) > 10000:
+			compiled.clear()
+		patterns = []
+		for regex in regexes:
+			pattern = compiled.get(regex)
+			if pattern is None:
+				pattern = compiled[regex] = re.compile(regex)
+			patterns.append(pattern)
+		for i, pattern in enumerate(patterns):
+			progress.value = i
+			if pattern.search(content):
+				conn.send(i)
+		conn.send(None)
+
+
+class _Worker:
+	"""
+	A RegexPool worker process, and the pipe and progress counter shared with it.
+	"""
+	def __init__(self, context):
+		self.conn, child_conn = context.Pipe()
+		self.progress = context.Value('i', -1, lock=False)
+		self.process = context.Process(target=_worker_main, args=(child_conn, self.progress), daemon=True)
+		self.process.start()
+		child_conn.close()
+
+	def kill(self):
+		self.process.kill()
+		self.conn.close()
+
+
+class RegexPool:
+	"""
+	Runs regex searches in worker processes, away from the event loop. If a search takes longer than timeout seconds, the worker running it is killed
+	(and replaced), so no regex, however slow, can hold up the bot for longer than that. Workers which die for any other reason are replaced too.
+	"""
+	def __init__(self, processes=2, timeout=0.1, max_wait=1):
+		"""Initialize the RegexPool, starting its' worker processes. Must be called from within a running event loop.
+		Searches which cannot get a worker within max_wait seconds (e.g. while every worker is being restarted) are skipped."""
+		self.timeout = timeout
+		self.max_wait = max_wait
+		self._context = multiprocessing.get_context('spawn')
+		self._idle = asyncio.Queue()
+		self._workers = set()
+		self._closed = False
+		for _ in range(processes):
+			self._start_worker()
+
+	def _start_worker(self, attempt=0):
+		"""Starts a new worker process, which becomes available once it has finished starting up (this does not count against anyone's time limit).
+		attempt is the number of times in a row starting a worker has failed; each retry waits twice as long as the last, up to a minute."""
+		asyncio.create_task(self._await_ready(attempt))
+
+	async def _await_ready(self, attempt):
+		if attempt:
+			await asyncio.sleep(min(2 ** (attempt - 1), 60))
+		if self._closed:
+			return
+		worker = None
+		try:
+			worker = _Worker(self._context)
+			self._workers.add(worker)
+			await asyncio.to_thread(worker.conn.recv)
+		except Exception:
+			# Failed to start (or died while starting) - try again later
+			if worker is not None:
+				worker.kill()
+				self._workers.discard(worker)
+			if not self._closed:
+				self._start_worker(attempt + 1)
+			return
+		if not self._closed:
+			self._idle.put_nowait(worker)
+
+	def _replace(self, worker):
+		"""Kills worker, and starts another in its' place."""
+		worker.kill()
+		self._workers.discard(worker)
+		if not self._closed:
+			self._start_worker()
+
+	@staticmethod
+	def _read_results(worker, found):
+		"""Appends every match index worker has sent so far to found. Returns True if the worker has also sent that it is done."""
+		while worker.conn.poll():
+			i = worker.conn.recv()
+			if i is None:
+				return True
+			found.append(i)
+		return False
+
+	async def _run(self, worker, regexes, content):
+		"""Runs regexes on content in worker, for at most self.timeout seconds. Returns (found, stopped): found is a list of the indices of the regexes that matched,
+		and stopped is the index of the regex that was running when the time limit passed, or None if every regex was run (or the worker died).
+		The worker is put back in the pool, or replaced if it ran out of time or died."""
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + self.timeout
+		found = []
+		worker.progress.value = -1
+		try:
+			worker.conn.send((regexes, content))
+			while await asyncio.to_thread(worker.conn.poll, max(deadline - loop.time(), 0)):
+				if self._read_results(worker, found):
+					self._idle.put_nowait(worker)
+					return found, None
+		except (EOFError, OSError):
+			# The worker died (e.g. it was killed for using too much memory) - replace it, and keep whatever it found before then
+			self._replace(worker)
+			return found, None
+
+		# Out of time - stop the worker, so that where it got to and what it found can no longer change, then replace it
+		worker.process.kill()
+		await asyncio.to_thread(worker.process.join)
+		progress = worker.progress.value
+		try:
+			finished = self._read_results(worker, found)
+		except (EOFError, OSError):
+			finished = False
+		self._replace(worker)
+		if finished or not 0 <= progress < len(regexes):
+			return found, None
+		return found, progress
+
+	async def search(self, regexes, content):
+		"""Runs every regex in regexes on content, in worker processes. Returns (matched, timed_out): matched is a list of the regexes that matched content,
+		in the order they were given, and timed_out is a list of the regexes which ran out of time. When one does, the regexes after it are run on
+		another worker, with a time limit of their own, so that one slow regex does not stop the others from matching.
+		If no worker becomes free within max_wait seconds, the remaining regexes are treated as matching nothing."""
+		matched = []
+		timed_out = []
+		while regexes:
+			try:
+				worker = await asyncio.wait_for(self._idle.get(), self.max_wait)
+			except asyncio.TimeoutError:
+				break
+			found, stopped = await self._run(worker, regexes, content)
+			matched.extend(regexes[i] for i in found)
+			if stopped is None:
+				break
+			# The regex which was running is only to blame if it had not already finished (and matched) when the worker was stopped
+			if not found or found[-1] != stopped:
+				timed_out.append(regexes[stopped])
+			regexes = regexes[stopped + 1:]
+		return matched, timed_out
+
+	def close(self):
+		"""Kills all worker processes."""
+		self._closed = True
+		for worker in self._workers:
+			worker.kill()
+		self._workers.clear()
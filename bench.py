@@ -0,0 +1,316 @@
+"""
+bench.py
+Offline benchmarks for tb3k's hot paths. Runs the cogs against local stand-ins for Discord objects (no connection or token needed),
+with a synthetic workload of GUILDS servers, each with RULES auto-responses and USERS members with birthdays.
+
+Usage:
+	python3 ./bench.py [--guilds N] [--rules M] [--users K] [--messages N] [--iterations N] [--seed N] [--output bench_output.txt]
+
+Prints (or writes to --output) a JSON object mapping each benchmark to its' results: 'ops' run, 'throughput' (ops per second),
+'p50_ms' and 'p99_ms' latencies, and 'peak_memory_bytes' allocated above what was in use when the benchmark started (measured with tracemalloc,
+which slows everything down somewhat, and only sees the main process - not the RegexPool workers).
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from datatree import SelfWritingDataTree
+
+
+class FakeTextChannel:
+	"""
+	Stand-in for discord.TextChannel. Records the messages sent to it instead of sending them.
+	"""
+	def __init__(self, id):
+		self.id = id
+		self.sent = []
+
+	async def send(self, content, reference=None, **kwargs):
+		self.sent.append(content)
+
+
+class FakeMember:
+	"""
+	Stand-in for discord.Member.
+	"""
+	def __init__(self, id, name=None, bot=False):
+		self.id = id
+		self.name = name or f"user{id}"
+		self.mention = f"<@{id}>"
+		self.bot = bot
+
+	def __eq__(self, other):
+		return getattr(other, 'id', None) == self.id
+
+	def __hash__(self):
+		return hash(self.id)
+
+
+class FakeGuild:
+	"""
+	Stand-in for discord.Guild. Like a bot running with MEMBER_CACHE = False, get_member() only finds members which have been cached,
+	so members have to be looked up with query_members().
+	"""
+	def __init__(self, id, members=(), cached=False):
+		self.id = id
+		self.system_channel = FakeTextChannel(id)
+		self.members = {member.id: member for member in members}
+		self.cached = cached
+
+	def get_member(self, user_id):
+		return self.members.get(user_id) if self.cached else None
+
+	async def query_members(self, query=None, *, limit=5, user_ids=None, presences=False, cache=True):
+		return [self.members[user_id] for user_id in (user_ids or ())[:limit] if user_id in self.members]
+
+
+class FakeMessage:
+	"""
+	Stand-in for discord.Message.
+	"""
+	def __init__(self, content, author, guild, channel):
+		self.content = content
+		self.author = author
+		self.guild = guild
+		self.channel = channel
+
+
+class FakeInteractionResponse:
+	"""
+	Stand-in for discord.InteractionResponse. Records the messages sent with it.
+	"""
+	def __init__(self):
+		self.sent = []
+
+	async def send_message(self, content, ephemeral=False, **kwargs):
+		self.sent.append(content)
+
+
+class FakeInteraction:
+	"""
+	Stand-in for discord.Interaction.
+	"""
+	def __init__(self, user, guild):
+		self.user = user
+		self.guild = guild
+		self.response = FakeInteractionResponse()
+
+
+class FakeBot:
+	"""
+	Stand-in for the TB3K bot, as seen by the cogs.
+	"""
+	def __init__(self, dt, guilds):
+		self.dt = dt
+		self.user = FakeMember(0, name="tb3k", bot=True)
+		self.guilds = {guild.id: guild for guild in guilds}
+
+	def get_guild(self, guild_id):
+		return self.guilds.get(guild_id)
+
+
+def load_cog(name, bot):
+	"""Creates the cog defined in cogs/name.py for bot, without going through discord.py's extension loading."""
+	module = importlib.import_module(f"cogs.{name}")
+	cog_class = next(value for key, value in vars(module).items() if key.endswith("Cog") and isinstance(value, type))
+	return module, cog_class(bot)
+
+
+def summarize(latencies, elapsed, peak_memory):
+	"""Returns the results of a benchmark, given the latency of each op and the total seconds elapsed."""
+	latencies = sorted(latencies)
+	return {
+		'ops': len(latencies),
+		'throughput': len(latencies) / elapsed if elapsed else None,
+		'p50_ms': latencies[len(latencies) // 2] * 1000,
+		'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+		'peak_memory_bytes': peak_memory,
+	}
+
+
+async def measure(op, n):
+	"""Awaits op(i) for i in range(n), and returns its' results (see summarize())."""
+	baseline = tracemalloc.get_traced_memory()[0]
+	tracemalloc.reset_peak()
+	latencies = []
+	start = time.perf_counter()
+	for i in range(n):
+		op_start = time.perf_counter()
+		await op(i)
+		latencies.append(time.perf_counter() - op_start)
+	elapsed = time.perf_counter() - start
+	return summarize(latencies, elapsed, tracemalloc.get_traced_memory()[1] - baseline)
+
+
+def build_state(args, rng, today):
+	"""Returns a dict tree (like data.json) with args.guilds servers, each with args.rules auto-responses and args.users birthdays,
+	about 1 in 50 of which are today."""
+	state = {}
+	for guild_id in range(1, args.guilds + 1):
+		birthdays = {}
+		for user_id in range(1, args.users + 1):
+			if rng.random() < 0.02:
+				birthdays[str(user_id)] = f"{rng.randint(1950, 2010)}-{today.month:02}-{today.day:02}"
+			else:
+				birthdays[str(user_id)] = f"{rng.randint(1950, 2010)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"
+		state[str(guild_id)] = {
+			'auto-responses': {
+				rf"(?i)\bword{i}\b": {'cooldown': -1, 'last-used': -1, 'probability': 1.0, 'response': f"Response number {i}!", 'times-used': 0}
+				for i in range(args.rules)
+			},
+			'birthdays': birthdays,
+		}
+	return state
+
+
+def random_message(args, rng):
+	"""Returns the content of a synthetic chat message, which mentions a word matched by an auto-response about 1 time in 10."""
+	words = [f"filler{rng.randrange(1000)}" for _ in range(rng.randint(3, 30))]
+	if rng.random() < 0.1:
+		words[rng.randrange(len(words))] = f"word{rng.randrange(args.rules)}"
+	return " ".join(words)
+
+
+async def bench_datatree(args, dirname, state):
+	"""Benchmarks SelfWritingDataTree: writing a full snapshot after a small change, and loading it back."""
+	filename = os.path.join(dirname, 'bench.json')
+	with open(filename, 'w') as f:
+		json.dump(state, f)
+	dt = SelfWritingDataTree(filename, save_delay=3600)
+
+	async def save(i):
+		dt['1']['bench'] = i
+		await dt.flush()
+
+	async def load(i):
+		SelfWritingDataTree(filename, save_delay=3600)
+
+	results = {
+		'datatree_save': await measure(save, args.iterations),
+		'datatree_load': await measure(load, args.iterations),
+	}
+	results['datatree_save']['bytes'] = os.path.getsize(filename)
+	await dt.close()
+	return results
+
+
+async def bench_on_message(args, rng, bot, cog):
+	"""Benchmarks AutoResponsesCog.on_message on a burst of args.messages messages spread over every server."""
+	guilds = list(bot.guilds.values())
+	author = FakeMember(args.users + 1)
+	messages = [FakeMessage(random_message(args, rng), author, rng.choice(guilds), FakeTextChannel(0)) for _ in range(args.messages)]
+
+	# Wait for the RegexPool workers to start, and build every server's RuleMatcher, before timing anything
+	for guild in guilds:
+		await cog.on_message(FakeMessage("word0", author, guild, FakeTextChannel(0)))
+
+	async def on_message(i):
+		await cog.on_message(messages[i])
+
+	result = await measure(on_message, len(messages))
+	result['responses'] = sum(len(message.channel.sent) for message in messages)
+	return result
+
+
+async def bench_birthday_printer(args, bot, cog, dispatcher_class):
+	"""Benchmarks BirthdayCog.birthday_printer for the default timezone's current UTC offset, without waiting between sends to the same channel."""
+	cog.dispatcher = dispatcher_class(channel_interval=0)
+	offset = datetime.now(cog.guild_timezone(0)).utcoffset()
+
+	async def birthday_printer(i):
+		await cog.birthday_printer(offset)
+
+	result = await measure(birthday_printer, args.iterations)
+	result['messages'] = sum(len(guild.system_channel.sent) for guild in bot.guilds.values())
+	return result
+
+
+async def bench_commands(args, rng, bot, birthday_cog, auto_responses_cog, authorized_user_id):
+	"""Benchmarks the slash command handlers, each run args.iterations times in random servers."""
+	guilds = list(bot.guilds.values())
+	admin = FakeMember(authorized_user_id)
+	user = FakeMember(args.users + 1)
+	target = FakeMember(1)
+
+	def interaction(member):
+		return FakeInteraction(member, rng.choice(guilds))
+
+	handlers = {
+		'set_birthday': lambda i: birthday_cog.set_birthday.callback(birthday_cog, interaction(user), "2000-01-01"),
+		'get_birthday': lambda i: birthday_cog.get_birthday.callback(birthday_cog, interaction(user), target),
+		'unset_birthday': lambda i: birthday_cog.unset_birthday.callback(birthday_cog, interaction(user)),
+		'set_auto_response': lambda i: auto_responses_cog.set_auto_response.callback(auto_responses_cog, interaction(admin), f"bench{i}", "Benchmark!", 0, 100),
+		'list_auto_responses': lambda i: auto_responses_cog.list_auto_responses.callback(auto_responses_cog, interaction(admin), 1 + i % 3),
+		'unset_auto_response': lambda i: auto_responses_cog.unset_auto_response.callback(auto_responses_cog, interaction(admin), f"bench{i}"),
+	}
+	return {f"command_{name}": await measure(handler, args.iterations) for name, handler in handlers.items()}
+
+
+async def run(args):
+	rng = random.Random(args.seed)
+	tracemalloc.start()
+	results = {}
+	with tempfile.TemporaryDirectory() as dirname:
+		# Storage
+		birthday_module = importlib.import_module("cogs.birthday")
+		today = datetime.now(ZoneInfo(birthday_module.DEFAULT_TIMEZONE)).date()
+		state = build_state(args, rng, today)
+		results.update(await bench_datatree(args, dirname, state))
+
+		# Cogs, with the servers and members they see
+		dt = SelfWritingDataTree(os.path.join(dirname, 'bench.json'), save_delay=3600)
+		guilds = [FakeGuild(guild_id, [FakeMember(user_id) for user_id in range(1, args.users + 1)]) for guild_id in range(1, args.guilds + 1)]
+		bot = FakeBot(dt, guilds)
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			auto_responses_module, auto_responses_cog = load_cog("auto-responses", bot)
+			_, birthday_cog = load_cog("birthday", bot)
+			await birthday_cog.cog_load()
+			try:
+				results['on_message'] = await bench_on_message(args, rng, bot, auto_responses_cog)
+				results['birthday_printer'] = await bench_birthday_printer(args, bot, birthday_cog, birthday_module.AnnouncementDispatcher)
+				results.update(await bench_commands(args, rng, bot, birthday_cog, auto_responses_cog, auto_responses_module.AUTHORIZED_USER_IDS[0]))
+			finally:
+				await auto_responses_cog.cog_unload()
+				await birthday_cog.cog_unload()
+				await dt.close()
+	tracemalloc.stop()
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Runs tb3k's offline benchmarks and prints the results as JSON.")
+	parser.add_argument('--guilds', type=int, default=50, help="Number of servers")
+	parser.add_argument('--rules', type=int, default=100, help="Number of auto-responses per server")
+	parser.add_argument('--users', type=int, default=500, help="Number of members with birthdays per server")
+	parser.add_argument('--messages', type=int, default=2000, help="Number of messages sent to on_message")
+	parser.add_argument('--iterations', type=int, default=50, help="Number of times every other benchmark is run")
+	parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic workload")
+	parser.add_argument('--output', help="Write the results to this file instead of printing them")
+	args = parser.parse_args()
+
+	results = {
+		'python': sys.version.split()[0],
+		'workload': {key: getattr(args, key) for key in ('guilds', 'rules', 'users', 'messages', 'iterations', 'seed')},
+		'results': asyncio.run(run(args)),
+	}
+	out = json.dumps(results, indent='\t')
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(out + '\n')
+	else:
+		print(out)
+
+
+if __name__ == '__main__':
+	main()
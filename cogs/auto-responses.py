@@ -6,18 +6,38 @@ Commands:
 	/set-auto-response regex response: If a non-bot user sends (in this server only) a message which matches regex (which can be either a valid regex string or a case-sensitive plain string), tb3k will reply to it with message. Only one response can exist for a specific regex, though a message may match multiple regexes and accordingly garner multiple replies.
 	/unset-auto-response regex: Removes an auto-response (in this server only) from this bot. regex must exactly match that of the response you want to delete.
 	/list-auto-responses: Lists all auto-responses configured for this server and their corresponding regexes.
+	The pages it shows are laid out once, and laid out again only when that server's auto-responses change.
+
+Usage counts ('times-used' and 'last-used') are kept in memory and written to the DataTree every USAGE_FLUSH_INTERVAL seconds (and on unload).
+
+Regexes are run in worker processes with a time limit of REGEX_TIMEOUT seconds per message. A regex which runs out of time is skipped, and the ones
+after it are given another REGEX_TIMEOUT seconds. An auto-response whose regex runs out of time REGEX_MAX_STRIKES times in a row is disabled until it is set again.
+Messages which cannot get a worker process within REGEX_MAX_WAIT seconds (e.g. while they are being restarted) are not responded to.
 """
 
+import heapq
 import re
 import random
 import time
 
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
+
+from automatch import RegexPool, RuleMatcher, is_pathological
+from metrics import get_logger, metrics
 
 
 AUTHORIZED_USER_IDS = [707353013286731846]
+REGEX_PROCESSES = 2
+REGEX_TIMEOUT = 0.1
+REGEX_MAX_WAIT = 1
+REGEX_MAX_STRIKES = 3
+USAGE_FLUSH_INTERVAL = 300
+# /list-auto-responses pages are laid out as if every usage count had this many digits, so that usage counts going up never move an auto-response to another page
+USAGE_COUNT_WIDTH = 12
+
+log = get_logger("auto-responses")
 
 
 def fmt_seconds(seconds):
@@ -35,61 +55,215 @@ def fmt_seconds(seconds):
 		return " and ".join(parts)
 
 
+class UsageStats:
+	"""
+	In-memory usage counts for auto-responses, so that sending a response does not have to write to the DataTree.
+	Counts recorded here are added to those stored in the DataTree by flush().
+	"""
+	def __init__(self):
+		# Maps (server id, regex) to [uses since the last flush, unix time of the latest use]
+		self.pending = {}
+
+	def record(self, guild_id, regex, utime):
+		"""Records that the auto-response for regex was sent in a server at the unix time utime."""
+		counts = self.pending.get((str(guild_id), regex))
+		if counts is None:
+			self.pending[(str(guild_id), regex)] = [1, utime]
+		else:
+			counts[0] += 1
+			counts[1] = utime
+
+	def times_used(self, guild_id, regex, rule):
+		"""Returns how many times the auto-response rule (stored under regex) has been used, including uses not flushed yet."""
+		counts = self.pending.get((str(guild_id), regex))
+		return rule["times-used"] + (counts[0] if counts else 0)
+
+	def last_used(self, guild_id, regex, rule):
+		"""Returns the unix time the auto-response rule (stored under regex) was last used, including uses not flushed yet."""
+		counts = self.pending.get((str(guild_id), regex))
+		return counts[1] if counts else rule["last-used"]
+
+	def discard(self, guild_id, regex=None):
+		"""Forgets unflushed uses of the auto-response for regex in a server (or all of that server's auto-responses, if regex is None)."""
+		guild_id = str(guild_id)
+		for key in [key for key in self.pending if key[0] == guild_id and regex in (None, key[1])]:
+			del self.pending[key]
+
+	def flush(self, dt):
+		"""Adds all unflushed uses to the usage counts stored in dt, skipping auto-responses which no longer exist."""
+		pending, self.pending = self.pending, {}
+		for (guild_id, regex), (uses, utime) in pending.items():
+			rule = dt.get((guild_id, "auto-responses", regex))
+			if rule is None:
+				continue
+			rule["times-used"] += uses
+			rule["last-used"] = utime
+
+
 class AutoResponsesCog(commands.Cog):
 	def __init__(self, bot):
 		self.bot = bot
-	
 
-	@app_commands.command(name="list-auto-responses", description="Lists all auto-responses set on this server")
-	@app_commands.describe(page="Page number (starting from 1)")
-	async def list_auto_responses(self, interaction: discord.Interaction, page: int = 1):
-		"""/list-auto-responses: Lists all auto-responses configured for this server and their corresponding regexes."""
-		print(f"[auto-responses] {interaction.user.name} ran command /list-auto-responses with args: page={page}")
+		# Compiled regexes for each server, built on first use and discarded whenever that server's auto-responses are added or removed
+		self.matchers = {}
+		self.bot.dt.subscribe("*/auto-responses/*", self.on_rules_changed)
 
-		# Do not run if not in AUTHORIZED_USER_IDS
-		if interaction.user.id not in AUTHORIZED_USER_IDS:
-			await interaction.response.send_message(f"{interaction.user.name} is not in the sudoers file.\nThis incident will be reported.", ephemeral=True)
-			return
-		
-		# Load auto-responses datatree
-		auto_response_dt = self.bot.dt[interaction.guild.id]["auto-responses"]
+		# Worker processes which run regexes, and how many times in a row each (server, regex) pair has run out of time
+		self.regex_pool = RegexPool(processes=REGEX_PROCESSES, timeout=REGEX_TIMEOUT, max_wait=REGEX_MAX_WAIT)
+		self.strikes = {}
+
+		# Min-heap of (unix time, server id, regex) for auto-responses which are deactivated in their server's RuleMatcher until their cooldown ends
+		self.cooldowns = []
+
+		# Usage counts which have not been written to the DataTree yet
+		self.usage = UsageStats()
+
+		# /list-auto-responses pages for each server, built on first use and discarded whenever that server's auto-responses change
+		self.pages = {}
+
+
+	async def cog_load(self):
+		self.flush_usage.start()
+
+
+	async def cog_unload(self):
+		self.flush_usage.cancel()
+		self.usage.flush(self.bot.dt)
+		self.bot.dt.unsubscribe("*/auto-responses/*", self.on_rules_changed)
+		self.regex_pool.close()
+
+
+	@tasks.loop(seconds=USAGE_FLUSH_INTERVAL)
+	async def flush_usage(self):
+		"""Writes usage counts to the DataTree every USAGE_FLUSH_INTERVAL seconds."""
+		self.usage.flush(self.bot.dt)
 
-		# Iterate through list of regexes and responses
-		page_out = [""]
-		curr_page = 1
+
+	def on_rules_changed(self, op, path, old, new):
+		"""DataTree subscription: discards a server's RuleMatcher when one of its' auto-responses is added, replaced, removed, disabled or re-enabled,
+		and its' /list-auto-responses pages when anything but an auto-response's usage count changes.
+		Other changes within a single auto-response (e.g. its' usage count) do not affect which regexes are run, so they are ignored."""
+		if len(path) <= 3 or path[3] == "disabled":
+			self.matchers.pop(path[0], None)
+		if len(path) <= 3 or path[3] not in ("times-used", "last-used"):
+			self.pages.pop(path[0], None)
+		# Unflushed uses of an auto-response which was replaced or removed no longer apply to anything
+		if len(path) <= 3:
+			self.usage.discard(path[0], path[2] if len(path) == 3 else None)
+
+
+	def get_matcher(self, guild_id, auto_response_dt):
+		"""Returns the RuleMatcher for a server, building it from auto_response_dt if needed."""
+		guild_id = str(guild_id)
+		matcher = self.matchers.get(guild_id)
+		if matcher is None:
+			enabled = [regex for regex in auto_response_dt if not auto_response_dt.get((regex, "disabled"), False)]
+			matcher = self.matchers[guild_id] = RuleMatcher(enabled)
+			curr_utime = int(time.time())
+			for regex in enabled:
+				rule = auto_response_dt[regex]
+				last_utime = self.usage.last_used(guild_id, regex, rule)
+				if (last_utime + rule["cooldown"]) >= curr_utime:
+					self.start_cooldown(guild_id, regex, last_utime + rule["cooldown"] + 1)
+		return matcher
+
+
+	def get_pages(self, guild_id, auto_response_dt):
+		"""Returns the /list-auto-responses pages for a server, laying them out from auto_response_dt if needed.
+		Each page is a list of (regex, text before its' usage count, text after its' usage count) for the auto-responses on that page."""
+		guild_id = str(guild_id)
+		pages = self.pages.get(guild_id)
+		if pages is not None:
+			return pages
+
+		pages = [[]]
 		curr_page_chars = 0
 		for regex in auto_response_dt:
 			# Get regex response and truncate to 200 chars at most
-			response = auto_response_dt[regex]['response']
+			rule = auto_response_dt[regex]
+			response = str(rule['response'])
 			response = response if len(response) <= 200 else (response[:147] + "..." + response[-50:])
-			cooldown = fmt_seconds(int(auto_response_dt[regex]['cooldown']))
-			probability = int(float(auto_response_dt[regex]['probability'])*100)
-			total_uses = auto_response_dt[regex]['times-used']
+			cooldown = fmt_seconds(rule['cooldown'])
+			probability = int(rule['probability']*100)
 
-			# Compose current bullet point
-			message = f"\n- Messages that match the regex `{regex}` will be replied to with: `{response}`. This response will activate {probability}% of the time, with at minimum {cooldown} between uses. It's been used {total_uses} times."
+			# Compose current bullet point, leaving out its' usage count
+			before = f"\n- Messages that match the regex `{regex}` will be replied to with: `{response}`. This response will activate {probability}% of the time, with at minimum {cooldown} between uses. It's been used "
+			after = " times."
+			if rule.get("disabled", False):
+				after += " It has been disabled because its' regex took too long to run; set it again to re-enable it."
+			length = len(before) + USAGE_COUNT_WIDTH + len(after)
 
 			# Turn page if necessary
-			if (curr_page_chars + len(message)) > 1900:
-				curr_page += 1
+			if (curr_page_chars + length) > 1900:
+				pages.append([])
 				curr_page_chars = 0
 
 			# Add to current page
-			curr_page_chars += len(message)
-			if curr_page == page:
-				page_out.append(message)
+			curr_page_chars += length
+			pages[-1].append((regex, before, after))
+
+		if not pages[0]:
+			pages = []
+		self.pages[guild_id] = pages
+		return pages
+
+
+	def start_cooldown(self, guild_id, regex, expires):
+		"""Stops running regex in a server until the unix time expires, since its' auto-response could not be sent before then anyway."""
+		guild_id = str(guild_id)
+		matcher = self.matchers.get(guild_id)
+		if matcher is not None:
+			matcher.deactivate(regex)
+		heapq.heappush(self.cooldowns, (expires, guild_id, regex))
+
+
+	def end_cooldowns(self, curr_utime):
+		"""Resumes running every regex whose cooldown has ended by the unix time curr_utime."""
+		while self.cooldowns and self.cooldowns[0][0] <= curr_utime:
+			_, guild_id, regex = heapq.heappop(self.cooldowns)
+			matcher = self.matchers.get(guild_id)
+			if matcher is not None:
+				matcher.activate(regex)
+
+
+	def strike(self, guild_id, auto_response_dt, regex):
+		"""Records that regex ran out of time in a server, disabling its' auto-response once this has happened REGEX_MAX_STRIKES times in a row."""
+		key = (str(guild_id), regex)
+		self.strikes[key] = self.strikes.get(key, 0) + 1
+		metrics.incr("regex_timeouts")
+		log.warning("Regex ran out of time", guild=str(guild_id), regex=regex, strikes=self.strikes[key], max_strikes=REGEX_MAX_STRIKES)
+		if self.strikes[key] >= REGEX_MAX_STRIKES and regex in auto_response_dt:
+			log.warning("Disabling auto-response", guild=str(guild_id), regex=regex)
+			auto_response_dt[regex]["disabled"] = True
+			del self.strikes[key]
+	
+
+	@app_commands.command(name="list-auto-responses", description="Lists all auto-responses set on this server")
+	@app_commands.describe(page="Page number (starting from 1)")
+	@metrics.timed("command:/list-auto-responses")
+	async def list_auto_responses(self, interaction: discord.Interaction, page: int = 1):
+		"""/list-auto-responses: Lists all auto-responses configured for this server and their corresponding regexes."""
+		log.info("Ran command /list-auto-responses", user=interaction.user.name, page=page)
+
+		# Do not run if not in AUTHORIZED_USER_IDS
+		if interaction.user.id not in AUTHORIZED_USER_IDS:
+			await interaction.response.send_message(f"{interaction.user.name} is not in the sudoers file.\nThis incident will be reported.", ephemeral=True)
+			return
 		
-		# Ensure that page header is less than 100 chars (so full msg is less than 2000 chars)
-		adj_page = page if len(str(page)) <= 33 else "[large number]"
-		adj_curr_page = curr_page if len(str(curr_page)) <= 33 else "[large number]"
+		# Load auto-responses datatree and its' pages
+		auto_response_dt = self.bot.dt.get((interaction.guild.id, "auto-responses"), {})
+		pages = self.get_pages(interaction.guild.id, auto_response_dt)
 
-		# Build output
-		if (curr_page == 1) and (curr_page_chars == 0):
+		# Build output, filling in usage counts (which change too often to be laid out ahead of time)
+		if not pages:
 			out = "You haven't set any auto responses for this server yet."
-		elif len(page_out) == 1:
-			out = f"This page doesn't exist. ({adj_curr_page} pages exist)"
+		elif not (1 <= page <= len(pages)):
+			out = f"This page doesn't exist. ({len(pages)} pages exist)"
 		else:
-			page_out[0] = f"Showing messages from page {adj_page} of {adj_curr_page}:\n"
+			page_out = [f"Showing messages from page {page} of {len(pages)}:\n"]
+			for regex, before, after in pages[page - 1]:
+				total_uses = self.usage.times_used(interaction.guild.id, regex, auto_response_dt[regex])
+				page_out.append(f"{before}{total_uses}{after}")
 			out = "".join(page_out)
 
 		# Send output
@@ -101,13 +275,14 @@ class AutoResponsesCog(commands.Cog):
 	@app_commands.describe(response="The message you would like to send if someone's message content matched the regex.")
 	@app_commands.describe(cooldown="The minimum time (in seconds) after this response is used once for which it will not be used again.")
 	@app_commands.describe(probability="The percent chance that this response will be activated if the regex matches a message sent.")
+	@metrics.timed("command:/set-auto-response")
 	async def set_auto_response(self, interaction: discord.Interaction, regex: str, response: str, cooldown: int, probability: int):
 		"""/set-auto-response regex response cooldown probability:
 		- If a non-bot user sends (in this server only) a message which matches regex (which can be either a valid regex string or a case-sensitive plain string),
 		- and the auto response is not within its' cooldown period,
 		- then tb3k will reply to it with message with a certain chance (probability) of it happening.
 		- Only one response can exist for a specific regex, though a message may match multiple regexes and accordingly garner multiple replies."""
-		print(f"[auto-responses] {interaction.user.name} ran command /set-auto-response with args: regex={regex} response={response}")
+		log.info("Ran command /set-auto-response", user=interaction.user.name, regex=regex, response=response)
 
 		# Do not run if not in AUTHORIZED_USER_IDS
 		if interaction.user.id not in AUTHORIZED_USER_IDS:
@@ -120,6 +295,11 @@ class AutoResponsesCog(commands.Cog):
 		except re.error:
 			await interaction.response.send_message("Your regex is invalid, malformed, uses an unsupported character or is otherwise syntactically incorrect. Maybe try double checking your spelling, capitalization, and escape sequences?", ephemeral=True)
 			return
+
+		# Check if regex could take too long to run
+		if is_pathological(regex):
+			await interaction.response.send_message("Your regex repeats something which itself repeats without limit (like `(a+)+` or `(\\w*\\s?)*`), which can make it take far too long to run. Try rewriting it so that no repeated group contains `*`, `+` or `{n,}`.", ephemeral=True)
+			return
 		
 		# Save new auto response
 		self.bot.dt[interaction.guild.id]["auto-responses"][regex] = {
@@ -134,9 +314,10 @@ class AutoResponsesCog(commands.Cog):
 
 	@app_commands.command(name="unset-auto-response", description="Remove an auto-response")
 	@app_commands.describe(regex="The regex associated with the auto-response you would like to remove.")
+	@metrics.timed("command:/unset-auto-response")
 	async def unset_auto_response(self, interaction: discord.Interaction, regex: str):
 		"""/unset-auto-response regex: Removes an auto-response (in this server only) from this bot. regex must exactly match that of the response you want to delete."""
-		print(f"[auto-responses] {interaction.user.name} ran command /unset-auto-response with args: regex={regex}")
+		log.info("Ran command /unset-auto-response", user=interaction.user.name, regex=regex)
 
 		# Do not run if not in AUTHORIZED_USER_IDS
 		if interaction.user.id not in AUTHORIZED_USER_IDS:
@@ -146,7 +327,7 @@ class AutoResponsesCog(commands.Cog):
 		# Check if set
 		if regex in self.bot.dt[interaction.guild.id]["auto-responses"]:
 			# Set - clear birthday and tell user
-			total_uses = self.bot.dt[interaction.guild.id]["auto-responses"][regex]['times-used']
+			total_uses = self.usage.times_used(interaction.guild.id, regex, self.bot.dt[interaction.guild.id]["auto-responses"][regex])
 			deleted_response = self.bot.dt[interaction.guild.id]["auto-responses"][regex]['response']
 			del self.bot.dt[interaction.guild.id]["auto-responses"][regex]
 			await interaction.response.send_message(f"Done! The regex response associated with `{regex}` has been deleted. It was associated with the response `{deleted_response}` and was used {total_uses} times.", ephemeral=True)
@@ -157,38 +338,59 @@ class AutoResponsesCog(commands.Cog):
 
 
 	@commands.Cog.listener()
+	@metrics.timed("listener:on_message")
 	async def on_message(self, message):
 		# Do not respond to other bots (or yourself)
 		if message.author.bot:
 			return
 		
 		# Load auto-responses datatree
-		auto_response_dt = self.bot.dt[message.guild.id]["auto-responses"]
+		auto_response_dt = self.bot.dt.get((message.guild.id, "auto-responses"))
+		if auto_response_dt is None:
+			return
+		metrics.incr("messages_scanned")
+
+		# Find which regexes match, within the time limit (skipping those in their cooldown period)
+		self.end_cooldowns(int(time.time()))
+		matcher = self.get_matcher(message.guild.id, auto_response_dt)
+		candidates = matcher.candidate_regexes(message.content)
+		with metrics.timer("regex_search"):
+			matched, timed_out = await self.regex_pool.search(candidates, message.content)
+		metrics.incr("rules_matched", len(matched))
+		for regex in timed_out:
+			self.strike(message.guild.id, auto_response_dt, regex)
+		if self.strikes:
+			for regex in candidates:
+				if regex not in timed_out:
+					self.strikes.pop((str(message.guild.id), regex), None)
 
 		# Respond to many possible messages
-		for regex in auto_response_dt:
-			if re.search(regex, message.content):
-				print(f"[auto-responses] {message.author.name} said something which matched the regex {regex}")
-
-				# Check cooldown
-				cooldown = int(auto_response_dt[regex]["cooldown"])
-				curr_utime = int(time.time())
-				last_utime = int(auto_response_dt[regex]["last-used"])
-				if ((last_utime + cooldown) >= curr_utime):
-					print("\tAuto response not sent due to cooldown.")
-					return
-				
-				# Check probability
-				probability = float(auto_response_dt[regex]["probability"])
-				if (random.random() >= probability):
-					print("\tAuto response not sent due to probability.")
-					return
-
-				# Both checks passed - send message
-				print("\tAuto response sent!")
-				auto_response_dt[regex]["last-used"] = int(time.time())
-				auto_response_dt[regex]["times-used"] = int(auto_response_dt[regex]["times-used"]) + 1
-				await message.channel.send(auto_response_dt[regex]["response"], reference=message)
+		for regex in matched:
+			if regex not in auto_response_dt:
+				continue
+
+
+			# Check cooldown
+			rule = auto_response_dt[regex]
+			curr_utime = int(time.time())
+			last_utime = self.usage.last_used(message.guild.id, regex, rule)
+			if ((last_utime + rule["cooldown"]) >= curr_utime):
+				log.debug("Auto-response not sent due to cooldown", user=message.author.name, regex=regex)
+				self.start_cooldown(message.guild.id, regex, last_utime + rule["cooldown"] + 1)
+				continue
+			
+			# Check probability
+			if (random.random() >= rule["probability"]):
+				log.debug("Auto-response not sent due to probability", user=message.author.name, regex=regex)
+				continue
+
+			# Both checks passed - send message
+			log.debug("Auto-response sent", user=message.author.name, regex=regex)
+			metrics.incr("auto_responses_sent")
+			self.usage.record(message.guild.id, regex, curr_utime)
+			if rule["cooldown"] >= 0:
+				self.start_cooldown(message.guild.id, regex, curr_utime + rule["cooldown"] + 1)
+			await message.channel.send(rule["response"], reference=message)
 
 	
 
@@ -6,10 +6,18 @@ Commands:
 	/set-birthday birthday: Sets the birthday of the user who runs this command. birthday is given in YYYY-MM-DD format.
 	/unset-birthday: Removes the birthday of the user who runs this command.
 	/get-birthday user: Gets the birthday of any member of the server, if they set it.
+	/set-timezone timezone: Sets the timezone birthdays are announced in for this server. Only permits users in AUTHORIZED_USER_IDS to do so.
+
+Birthdays are announced at 7AM in each server's timezone (DEFAULT_TIMEZONE if it has not set one). Servers are grouped by their current UTC offset,
+with one scheduled job per offset, so each job only announces birthdays for the servers where it is currently 7AM.
 """
 
-from datetime import datetime
-from zoneinfo import ZoneInfo
+import asyncio
+import calendar
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
@@ -18,8 +26,20 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
+from metrics import get_logger, metrics
+
 
-TIMEZONE = "US/Eastern"
+AUTHORIZED_USER_IDS = [707353013286731846]
+DEFAULT_TIMEZONE = "US/Eastern"
+# Birthday announcements are sent in up to this many servers at once, at most once every CHANNEL_SEND_INTERVAL seconds per channel,
+# and failed sends are retried up to SEND_RETRIES times, waiting 1, 2, 4... seconds in between
+MAX_CONCURRENT_SENDS = 8
+CHANNEL_SEND_INTERVAL = 1.0
+SEND_RETRIES = 3
+# Members looked up for birthday announcements (when the bot does not keep a member cache) are remembered for this many seconds
+MEMBER_TTL = 3600
+
+log = get_logger("birthday")
 
 
 def ord(n):
@@ -48,21 +68,268 @@ def format_date(date_str):
 	return formatted_date
 
 
+class BirthdayIndex:
+	"""
+	Index of every birthday the bot knows, by (month, day). Each day's birthdays are stored as a flat array of (guild id, user id, birth year) triples.
+	"""
+	def __init__(self):
+		self.days = {}
+
+	def add(self, guild_id, user_id, birthday):
+		"""Adds a user's birthday (an ISO 8601 date string) in a server to the index."""
+		y, m, d = unpack_iso_date(birthday)
+		self.days.setdefault((m, d), array('Q')).extend((int(guild_id), int(user_id), y))
+
+	def remove(self, guild_id, user_id, birthday):
+		"""Removes a user's birthday (an ISO 8601 date string) in a server from the index."""
+		y, m, d = unpack_iso_date(birthday)
+		entries = self.days.get((m, d))
+		if entries is None:
+			return
+		entry = (int(guild_id), int(user_id), y)
+		for i in range(0, len(entries), 3):
+			if tuple(entries[i:i+3]) == entry:
+				del entries[i:i+3]
+				break
+		if not entries:
+			del self.days[(m, d)]
+
+	def on(self, date):
+		"""Returns a list of (guild id, user id, birth year) for every birthday to celebrate on date.
+		In years without a February 29th, birthdays on February 29th are celebrated on February 28th."""
+		days = [(date.month, date.day)]
+		if (date.month, date.day) == (2, 28) and not calendar.isleap(date.year):
+			days.append((2, 29))
+		out = []
+		for day in days:
+			entries = self.days.get(day, ())
+			out.extend(tuple(entries[i:i+3]) for i in range(0, len(entries), 3))
+		return out
+
+
+def birthday_messages(birthdays):
+	"""Given a list of (user mention, age) for the birthdays in one server today, returns a list of messages announcing all of them.
+	Birthdays are combined into as few messages as possible, keeping each under Discord's 2000 character limit."""
+	parts = [f"{mention}'s {ord(age)}" for mention, age in birthdays]
+	messages = []
+	while parts:
+		count = len(parts)
+		while count > 1 and len(_birthday_message(parts[:count])) > 2000:
+			count -= 1
+		messages.append(_birthday_message(parts[:count]))
+		parts = parts[count:]
+	return messages
+
+
+def _birthday_message(parts):
+	"""Joins a list of "(user mention)'s (Nth)" strings into one birthday announcement."""
+	joined = parts[0] if len(parts) == 1 else ", ".join(parts[:-1]) + " and " + parts[-1]
+	return f"Today is {joined} birthday! Wish {'them' if len(parts) == 1 else 'them all'} a happy birthday!"
+
+
+class AnnouncementDispatcher:
+	"""
+	Sends messages to many channels concurrently: to at most max_concurrency channels at once, to each channel at most once every channel_interval seconds,
+	retrying sends which fail with a (possibly temporary) HTTP error up to retries times with exponential backoff.
+	"""
+	def __init__(self, max_concurrency=MAX_CONCURRENT_SENDS, channel_interval=CHANNEL_SEND_INTERVAL, retries=SEND_RETRIES):
+		self.semaphore = asyncio.Semaphore(max_concurrency)
+		self.channel_interval = channel_interval
+		self.retries = retries
+		# Maps channel ids to the earliest time (from time.monotonic()) another message may be sent to them
+		self.next_send = {}
+
+	async def send_all(self, announcements):
+		"""Sends every message in announcements, a list of (channel, [messages]) pairs. Returns a dict of statistics: 'sent' and 'failed' messages, and 'elapsed' seconds."""
+		stats = {'sent': 0, 'failed': 0}
+		start = time.monotonic()
+		await asyncio.gather(*(self._send_channel(channel, messages, stats) for channel, messages in announcements))
+		stats['elapsed'] = time.monotonic() - start
+		now = time.monotonic()
+		self.next_send = {channel_id: t for channel_id, t in self.next_send.items() if t > now}
+		return stats
+
+	async def _send_channel(self, channel, messages, stats):
+		"""Sends messages to channel in order, respecting the per-channel interval."""
+		async with self.semaphore:
+			for message in messages:
+				delay = self.next_send.get(channel.id, 0) - time.monotonic()
+				if delay > 0:
+					await asyncio.sleep(delay)
+				self.next_send[channel.id] = time.monotonic() + self.channel_interval
+				stats['sent' if await self._send(channel, message) else 'failed'] += 1
+
+	async def _send(self, channel, message):
+		"""Sends a message to channel, retrying on failure. Returns True if it was sent."""
+		for attempt in range(self.retries + 1):
+			try:
+				await channel.send(message)
+				return True
+			except (discord.Forbidden, discord.NotFound) as e:
+				# Retrying will not help
+				log.warning("Could not send announcement", channel=channel.id, error=str(e))
+				return False
+			except discord.HTTPException as e:
+				log.warning("Could not send announcement", channel=channel.id, attempt=attempt + 1, attempts=self.retries + 1, error=str(e))
+				if attempt < self.retries:
+					await asyncio.sleep(2 ** attempt)
+		return False
+
+
+class MemberResolver:
+	"""
+	Looks up members of a server. Uses the bot's member cache when it has one; otherwise, fetches the members that are needed in bulk
+	and remembers them (including which users are no longer in the server) for ttl seconds.
+	"""
+	def __init__(self, ttl=MEMBER_TTL, max_size=10000):
+		self.ttl = ttl
+		self.max_size = max_size
+		# Maps (guild id, user id) to (time.monotonic() at which the entry expires, discord.Member or None)
+		self.cache = {}
+
+	async def resolve(self, guild, user_ids):
+		"""Returns a dict of user ids to discord.Members for every user in user_ids who is a member of guild."""
+		now = time.monotonic()
+		found = {}
+		missing = []
+		for user_id in user_ids:
+			member = guild.get_member(user_id)
+			cached = self.cache.get((guild.id, user_id))
+			if member is not None:
+				found[user_id] = member
+			elif (cached is not None) and (cached[0] > now):
+				if cached[1] is not None:
+					found[user_id] = cached[1]
+			else:
+				missing.append(user_id)
+
+		# Fetch members which weren't cached, 100 at a time (the most Discord allows per request)
+		if len(self.cache) + len(missing) > self.max_size:
+			self.cache = {key: value for key, value in self.cache.items() if value[0] > now}
+		for i in range(0, len(missing), 100):
+			chunk = missing[i:i+100]
+			try:
+				members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=False)
+			except asyncio.TimeoutError:
+				log.warning("Timed out looking up members", guild=guild.id, members=len(chunk))
+				continue
+			members = {member.id: member for member in members}
+			for user_id in chunk:
+				member = members.get(user_id)
+				self.cache[(guild.id, user_id)] = (now + self.ttl, member)
+				if member is not None:
+					found[user_id] = member
+		return found
+
+
+def _birthdays_in(path, value):
+	"""Given a path changed in the DataTree (which a '*/birthdays/*' subscription was notified about) and its' old or new value, returns a dict of
+	user ids to birthdays for all the birthdays in value."""
+	if len(path) == 1:
+		value = value.get('birthdays') if isinstance(value, dict) else None
+	elif len(path) == 3:
+		value = {path[2]: value} if value is not None else None
+	return value if isinstance(value, dict) else {}
+
+
+def _scan_guilds(dt):
+	"""Returns a BirthdayIndex of every birthday in dt and a dict of every server's timezone, reading each server once (see DataTree.scan()).
+	Run in a worker thread, since with sharded storage this reads every server's file."""
+	index = BirthdayIndex()
+	timezones = {}
+	for guild_id, guild in dt.scan():
+		for user_id, birthday in _birthdays_in((guild_id,), guild).items():
+			index.add(guild_id, user_id, birthday)
+		tz = guild.get('timezone') if isinstance(guild, dict) else None
+		if tz is not None:
+			timezones[guild_id] = tz
+	return index, timezones
+
+
 class BirthdayCog(commands.Cog):
 	def __init__(self, bot):
 		self.bot = bot
-		
-		# Run birthday_printer() every day at 7AM Eastern Time
-		scheduler = AsyncIOScheduler()
-		scheduler.add_job(self.birthday_printer, CronTrigger(hour=7, minute=0, second=0, timezone=ZoneInfo(TIMEZONE)))
-		scheduler.start()
+
+		# Index of birthdays by date, and each server's timezone, filled in by cog_load()
+		self.index = BirthdayIndex()
+		self.timezones = {}
+
+		# Run birthday_printer() every day at 7AM for each UTC offset in use, and re-check which offsets are in use every hour (to keep up with DST)
+		self.scheduler = AsyncIOScheduler()
+		self.scheduler.add_job(self.refresh_offsets, CronTrigger(minute=30))
+		self.dispatcher = AnnouncementDispatcher()
+		self.members = MemberResolver()
+
+
+	async def cog_load(self):
+		# Build the birthday index and find each server's timezone in one pass over storage, then keep both up to date as they change
+		self.index, self.timezones = await asyncio.to_thread(_scan_guilds, self.bot.dt)
+		self.bot.dt.subscribe("*/birthdays/*", self.on_birthdays_changed)
+		self.bot.dt.subscribe("*/timezone", self.on_timezone_changed)
+
+		self.schedule_offsets()
+		self.scheduler.start()
+
+
+	async def cog_unload(self):
+		self.bot.dt.unsubscribe("*/birthdays/*", self.on_birthdays_changed)
+		self.bot.dt.unsubscribe("*/timezone", self.on_timezone_changed)
+		self.scheduler.shutdown(wait=False)
+
+
+	def on_timezone_changed(self, op, path, old, new):
+		"""DataTree subscription: keeps self.timezones up to date when a server's timezone is set (or the server is deleted)."""
+		tz = new.get('timezone') if (len(path) == 1 and isinstance(new, dict)) else new if len(path) == 2 else None
+		if tz is None:
+			self.timezones.pop(path[0], None)
+		else:
+			self.timezones[path[0]] = tz
+		self.schedule_offsets()
+
+
+	def guild_timezone(self, guild_id):
+		"""Returns the ZoneInfo of a server's timezone."""
+		return ZoneInfo(self.timezones.get(str(guild_id), DEFAULT_TIMEZONE))
+
+
+	async def refresh_offsets(self):
+		"""Hourly job which runs schedule_offsets(). It is a coroutine so that the scheduler runs it on the event loop (like every other caller),
+		rather than in a worker thread, where it could race with on_timezone_changed()."""
+		self.schedule_offsets()
+
+
+	def schedule_offsets(self):
+		"""Makes sure there is exactly one birthday_printer() job for every UTC offset that a server's timezone has now or will have in the next day."""
+		now = datetime.now(timezone.utc)
+		offsets = set()
+		for tz in set(self.timezones.values()) | {DEFAULT_TIMEZONE}:
+			for when in (now, now + timedelta(days=1)):
+				offsets.add(when.astimezone(ZoneInfo(tz)).utcoffset())
+
+		jobs = {job.id: job for job in self.scheduler.get_jobs() if job.id.startswith("birthdays ")}
+		for offset in offsets:
+			job_id = f"birthdays {offset.total_seconds():+.0f}"
+			if jobs.pop(job_id, None) is None:
+				self.scheduler.add_job(self.birthday_printer, CronTrigger(hour=7, minute=0, second=0, timezone=timezone(offset)), args=[offset], id=job_id)
+		for job in jobs.values():
+			job.remove()
+
+
+	def on_birthdays_changed(self, op, path, old, new):
+		"""DataTree subscription: updates the birthday index when a birthday (or a whole server) is set or deleted."""
+		guild_id = path[0]
+		for user_id, birthday in _birthdays_in(path, old).items():
+			self.index.remove(guild_id, user_id, birthday)
+		for user_id, birthday in _birthdays_in(path, new).items():
+			self.index.add(guild_id, user_id, birthday)
 	
 
 	@app_commands.command(name="set-birthday", description="Set your birthday")
 	@app_commands.describe(birthday="Your birthday, in ISO 8601 (YYYY-MM-DD) format (EXAMPLE: November 4th, 2004 is 2004-11-04)")
+	@metrics.timed("command:/set-birthday")
 	async def set_birthday(self, interaction: discord.Interaction, birthday: str):
 		"""/set-birthday birthday: Sets the birthday of the user who runs this command. birthday is given in YYYY-MM-DD format."""
-		print(f"[birthday] {interaction.user.name} ran command /set-birthday with args: birthday={birthday}")
+		log.info("Ran command /set-birthday", user=interaction.user.name, birthday=birthday)
 		
 		try:
 			# Attempt to parse as ISO8601 time
@@ -78,9 +345,10 @@ class BirthdayCog(commands.Cog):
 
 
 	@app_commands.command(name="unset-birthday", description="Unset your birthday")
+	@metrics.timed("command:/unset-birthday")
 	async def unset_birthday(self, interaction: discord.Interaction):
 		"""/unset-birthday: Removes the birthday of the user who runs this command."""
-		print(f"[birthday] {interaction.user.name} ran command /unset-birthday with no args")
+		log.info("Ran command /unset-birthday", user=interaction.user.name)
 
 		# Check if set
 		if interaction.user.id in self.bot.dt[interaction.guild.id]["birthdays"]:
@@ -94,14 +362,15 @@ class BirthdayCog(commands.Cog):
 
 	@app_commands.command(name="get-birthday", description="Check your (or someone else's) birthday")
 	@app_commands.describe(user="Target user")
+	@metrics.timed("command:/get-birthday")
 	async def get_birthday(self, interaction: discord.Interaction, user: discord.Member):
 		"""/get-birthday user: Gets the birthday of any member of the server, if they set it."""
-		print(f"[birthday] {interaction.user.name} ran command /get-birthday with args: user={user}")
+		log.info("Ran command /get-birthday", user=interaction.user.name, target=str(user))
 
 		# Check if set
-		if user.id in self.bot.dt[interaction.guild.id]["birthdays"]:
-			# Set - get birthday and tell user
-			birthday = self.bot.dt[interaction.guild.id]["birthdays"][user.id]
+		birthday = self.bot.dt.get((interaction.guild.id, "birthdays", user.id))
+		if birthday is not None:
+			# Set - tell user
 			await interaction.response.send_message(f"{user.mention}'s birthday is {format_date(birthday)}.", ephemeral=True)
 		else:
 			# Not set - tell user
@@ -115,33 +384,73 @@ class BirthdayCog(commands.Cog):
 			await interaction.response.send_message(msg, ephemeral=True)
 
 
-	async def birthday_printer(self):
-		"""Prints out happy birthday messages if it is someone's birthday.
-		Run automatically by __init__ and apscheduler. Will only send messages to servers with a system channel set."""
-		current_date = unpack_iso_date(datetime.now(ZoneInfo(TIMEZONE)).date().isoformat())
-		for guild_id in self.bot.dt.keys():
-			# Identify server
-			guild = self.bot.get_guild(int(guild_id))
+	@app_commands.command(name="set-timezone", description="Set the timezone birthdays are announced in for this server")
+	@app_commands.describe(timezone="An IANA timezone name (EXAMPLE: America/New_York, Europe/London, Asia/Tokyo)")
+	@metrics.timed("command:/set-timezone")
+	async def set_timezone(self, interaction: discord.Interaction, timezone: str):
+		"""/set-timezone timezone: Sets the timezone birthdays are announced in for this server. Only permits users in AUTHORIZED_USER_IDS to do so."""
+		log.info("Ran command /set-timezone", user=interaction.user.name, timezone=timezone)
+
+		# Do not run if not in AUTHORIZED_USER_IDS
+		if interaction.user.id not in AUTHORIZED_USER_IDS:
+			await interaction.response.send_message(f"{interaction.user.name} is not in the sudoers file.\nThis incident will be reported.", ephemeral=True)
+			return
+
+		try:
+			# Attempt to look up timezone
+			now = datetime.now(ZoneInfo(timezone))
+
+			# Successful? Write and tell user
+			self.bot.dt[interaction.guild.id]["timezone"] = timezone
+			await interaction.response.send_message(f"Done! Birthdays in this server will now be announced at 7AM {timezone} time (it is currently {now.strftime('%H:%M')} there).", ephemeral=True)
+
+		except (ZoneInfoNotFoundError, ValueError):
+			# Failed? Tell user
+			await interaction.response.send_message("That timezone doesn't exist. Please use a timezone name like America/New_York or Europe/London and try again.", ephemeral=True)
+
+
+	@metrics.timed("job:birthday_printer")
+	async def birthday_printer(self, offset):
+		"""Prints out happy birthday messages if it is someone's birthday, in every server whose timezone currently has the UTC offset offset.
+		Run automatically at 7AM (in that offset) by apscheduler. Will only send messages to servers with a system channel set.
+		All of a server's birthdays are announced together, and servers are announced to concurrently (see AnnouncementDispatcher)."""
+		now = datetime.now(timezone(offset))
+		today = now.date()
 
-			# Identify server system channel
-			channel = guild.system_channel
-			if not channel:
+		# Group today's birthdays by server, skipping those that can't be announced
+		skipped = 0
+		birth_years_by_guild = {}
+		for guild_id, user_id, birth_year in self.index.on(today):
+			# Ignore servers for which it is not 7AM yet (or anymore)
+			if now.astimezone(self.guild_timezone(guild_id)).utcoffset() != offset:
 				continue
 
-			# Cycle through users with registered birthdays
-			for user_id in self.bot.dt[guild_id]['birthdays'].keys():
-				# Ignore users who are no longer in the guild
-				if guild.get_member(int(user_id)) is None: 
-					continue
+			# Identify server and its' system channel, and ignore users who haven't been born yet
+			guild = self.bot.get_guild(guild_id)
+			if (guild is None) or (not guild.system_channel) or (today.year <= birth_year):
+				skipped += 1
+				continue
+			birth_years_by_guild.setdefault(guild, {})[user_id] = birth_year
 
-				# Get user info
-				user = guild.get_member(int(user_id))
-				user_birthday = unpack_iso_date(self.bot.dt[guild_id]['birthdays'][user_id])
+		# Look up the members with birthdays today, ignoring users who are no longer in their server
+		guilds = list(birth_years_by_guild)
+		members_by_guild = await asyncio.gather(*(self.members.resolve(guild, list(birth_years_by_guild[guild])) for guild in guilds))
+		birthdays_by_guild = {}
+		for guild, members in zip(guilds, members_by_guild):
+			for user_id, birth_year in birth_years_by_guild[guild].items():
+				user = members.get(user_id)
+				if user is None:
+					skipped += 1
+					continue
+				log.debug("Announcing birthday", guild=guild.id, user=user.name)
+				birthdays_by_guild.setdefault(guild, []).append((user.mention, today.year - birth_year))
 
-				# Send happy birthday msg if appropriate
-				if (current_date[1] == user_birthday[1]) and (current_date[2] == user_birthday[2]) and (current_date[0] > user_birthday[0]):
-					print(f"[birthday] Today is {user.name}'s birthday! Sending a celebratory message.")
-					await channel.send(f"Today is {user.mention}'s {ord(current_date[0] - user_birthday[0])} birthday! Wish them a happy birthday!")
+		# Send happy birthday msgs
+		announcements = [(guild.system_channel, birthday_messages(birthdays)) for guild, birthdays in birthdays_by_guild.items()]
+		stats = await self.dispatcher.send_all(announcements)
+		metrics.incr("birthday_messages_sent", stats['sent'])
+		metrics.incr("birthday_messages_failed", stats['failed'])
+		log.info("Birthday announcements done", offset=f"UTC{offset.total_seconds() / 3600:+g}", sent=stats['sent'], skipped=skipped, failed=stats['failed'], seconds=round(stats['elapsed'], 2))
 
 
 async def setup(bot):
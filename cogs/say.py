@@ -10,9 +10,13 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
+from metrics import get_logger, metrics
+
 
 AUTHORIZED_USER_IDS = [707353013286731846]
 
+log = get_logger("say")
+
 
 class SayCog(commands.Cog):
 	def __init__(self, bot):
@@ -21,9 +25,10 @@ class SayCog(commands.Cog):
 
 	@app_commands.command(name="say", description="Make tb3k say something")
 	@app_commands.describe(message="Your message")
+	@metrics.timed("command:/say")
 	async def say(self, interaction: discord.Interaction, message: str):
 		"""/say message: Tells tb3k to say something. Only permits users in AUTHORIZED_USER_IDS to do so."""
-		print(f"[say] {interaction.user.name} ran command /say with args: message={message}")
+		log.info("Ran command /say", user=interaction.user.name, message=message)
 
 		if interaction.user.id in AUTHORIZED_USER_IDS:
 			await interaction.response.send_message(f"Done!", ephemeral=True)
@@ -0,0 +1,80 @@
+"""
+cogs/stats.py
+Lets the owner of the bot see the metrics tb3k has collected since it started (see metrics.py), and profile it (see diagnostics.py).
+
+Commands:
+	/stats: Shows every counter, and the latencies of every command, listener and save. Only permits the bot's owner to do so.
+	/profile seconds: Profiles the bot for some seconds, and saves the result to a file. Only permits the bot's owner to do so, and only if DIAGNOSTICS is enabled.
+"""
+
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+from metrics import get_logger, metrics
+
+
+log = get_logger("stats")
+MAX_PROFILE_SECONDS = 300
+
+
+def format_stats(snapshot):
+	"""Given the result of metrics.snapshot(), returns it as a message of at most 2000 characters."""
+	lines = [f"Up for {snapshot['uptime'] / 3600:.1f} hours", "", "Counters:"]
+	lines.extend(f"  {name}: {value}" for name, value in snapshot['counters'].items())
+	lines.extend(["", "Latencies (calls: p50 / p99 / max):"])
+	lines.extend(f"  {name}: {s['count']}: {s['p50_ms']:.2f}ms / {s['p99_ms']:.2f}ms / {s['max_ms']:.2f}ms" for name, s in snapshot['latencies'].items())
+	out = "\n".join(lines)
+	if len(out) > 1990:
+		out = out[:1986] + "\n..."
+	return f"```\n{out}```"
+
+
+class StatsCog(commands.Cog):
+	def __init__(self, bot):
+		self.bot = bot
+
+
+	@app_commands.command(name="stats", description="Show tb3k's performance metrics")
+	@metrics.timed("command:/stats")
+	async def stats(self, interaction: discord.Interaction):
+		"""/stats: Shows every counter, and the latencies of every command, listener and save. Only permits the bot's owner to do so."""
+		log.info("Ran command /stats", user=interaction.user.name)
+
+		if await self.bot.is_owner(interaction.user):
+			await interaction.response.send_message(format_stats(metrics.snapshot()), ephemeral=True)
+		else:
+			await interaction.response.send_message(f"{interaction.user.name} is not in the sudoers file.\nThis incident will be reported.", ephemeral=True)
+
+
+	@app_commands.command(name="profile", description="Profile tb3k for a while and save the result")
+	@app_commands.describe(seconds="How many seconds to profile for")
+	@metrics.timed("command:/profile")
+	async def profile(self, interaction: discord.Interaction, seconds: int = 30):
+		"""/profile seconds: Profiles the bot for some seconds, and saves the result to a file. Only permits the bot's owner to do so, and only if DIAGNOSTICS is enabled."""
+		log.info("Ran command /profile", user=interaction.user.name, seconds=seconds)
+
+		# Do not run if not the owner, or if diagnostics are off
+		if not await self.bot.is_owner(interaction.user):
+			await interaction.response.send_message(f"{interaction.user.name} is not in the sudoers file.\nThis incident will be reported.", ephemeral=True)
+			return
+		diagnostics = getattr(self.bot, 'diagnostics', None)
+		if diagnostics is None:
+			await interaction.response.send_message("Diagnostics are turned off. Set DIAGNOSTICS = True in tb3k.py and restart the bot to use this command.", ephemeral=True)
+			return
+		if not (1 <= seconds <= MAX_PROFILE_SECONDS):
+			await interaction.response.send_message(f"Profiles can be between 1 and {MAX_PROFILE_SECONDS} seconds long.", ephemeral=True)
+			return
+		if diagnostics.profiling:
+			await interaction.response.send_message("A profile is already being taken. Try again once it's done.", ephemeral=True)
+			return
+
+		# Profile, then tell the user where the result is (as a followup, since it takes longer than an interaction response may)
+		await interaction.response.send_message(f"Profiling for {seconds} seconds...", ephemeral=True)
+		filename = await diagnostics.profile(seconds)
+		await interaction.followup.send(f"Done! The profile was saved to `{filename}`.", ephemeral=True)
+
+
+async def setup(bot):
+	cog = StatsCog(bot)
+	await bot.add_cog(cog)
@@ -1,49 +1,175 @@
 import json
+import math
 import os
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from fnmatch import fnmatchcase
+from urllib.parse import quote, unquote
 
-import aiofiles
 import asyncio
 
+from metrics import get_logger, metrics
+
+log = get_logger("datatree")
+LEAF_TYPES = (str, int, float, bool, type(None))
+# Longest time (in seconds) to wait before retrying a save that failed
+MAX_RETRY_DELAY = 300
+
+
+def _parse_legacy(value):
+	"""Recovers the original type of a leaf which older versions of DataTree converted to a string.
+	Only values which str() reproduces exactly are converted, e.g. "5" becomes 5, but "007" and "nan" stay strings."""
+	for parse in (int, float):
+		try:
+			parsed = parse(value)
+		except ValueError:
+			continue
+		if str(parsed) == value and (parse is int or math.isfinite(parsed)):
+			return parsed
+	return {'True': True, 'False': False, 'None': None}.get(value, value)
+
+
+def _has_typed_leaves(obj):
+	"""Returns True if any leaf of obj (a dict loaded from JSON) is not a string."""
+	if isinstance(obj, dict):
+		return any(_has_typed_leaves(value) for value in obj.values())
+	return not isinstance(obj, str)
+
+
+def upgrade_legacy(obj):
+	"""Given data loaded from JSON, returns it with its' leaves converted back to native types if it was saved by an older version of DataTree
+	(which stored every leaf as a string). Data containing any non-string leaf is already typed and is returned unchanged."""
+	if _has_typed_leaves(obj):
+		return obj
+	return _parse_legacy_tree(obj)
+
+
+def _parse_legacy_tree(obj):
+	"""Applies _parse_legacy() to every leaf of obj."""
+	if isinstance(obj, dict):
+		return {key: _parse_legacy_tree(value) for key, value in obj.items()}
+	return _parse_legacy(obj)
+
+
+def _fsync_dir(dirname):
+	"""Makes renames within dirname durable. Does nothing on platforms which cannot open directories (i.e. Windows)."""
+	try:
+		fd = os.open(dirname or '.', os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def _rotate_backups(filename, backups, backup_interval):
+	"""Keeps up to backups old copies of filename, as filename.1 (the newest) to filename.N, adding a new one at most every backup_interval seconds."""
+	newest = f"{filename}.1"
+	if not backups or not os.path.exists(filename):
+		return
+	if os.path.exists(newest) and time.time() - os.path.getmtime(newest) < backup_interval:
+		return
+	for i in range(backups - 1, 0, -1):
+		if os.path.exists(f"{filename}.{i}"):
+			os.replace(f"{filename}.{i}", f"{filename}.{i + 1}")
+	# Link (or copy) rather than move the current file, so that filename exists at all times
+	try:
+		os.link(filename, newest)
+	except OSError:
+		shutil.copy2(filename, newest)
+	os.utime(newest)
+
+
+def write_json_atomic(filename, obj, backups=0, backup_interval=3600):
+	"""Writes obj to filename as JSON, such that filename always holds either its' old or its' new contents in full, even after a crash.
+	The data is written to a temporary file, synced to disk, then renamed over filename. If backups is set, old copies are kept (see _rotate_backups()).
+	Blocks, so run it in a worker thread from async code. Returns the number of bytes written."""
+	data = json.dumps(obj, indent=4).encode()
+	tmp_filename = filename + '.tmp'
+	with open(tmp_filename, mode='wb') as f:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+	_rotate_backups(filename, backups, backup_interval)
+	os.replace(tmp_filename, filename)
+	_fsync_dir(os.path.dirname(filename))
+	return len(data)
+
+
+def _append_synced(filename, data):
+	"""Appends data to filename and syncs it to disk. Blocks, so run it in a worker thread from async code."""
+	with open(filename, mode='ab') as f:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+
+
 class DataTree:
 	"""
-	JSON style hierarchical data structure. Stores labels (strings) paired to data (either strings or other DataTrees). Automatically creates parent trees as needed, to avoid KeyErrors.
+	JSON style hierarchical data structure. Stores labels (strings) paired to data (either JSON leaves - strings, ints, floats, bools or None - or other DataTrees).
+	Automatically creates parent trees as needed, to avoid KeyErrors. Parent trees are only stored once something is written to them, so reads never grow the tree.
 	"""
-	def __init__(self, tree=None, parent=None):
-		"""Initialize the DataTree, loading existing data if needed."""
-		# Contains string-to-string and string-to-DataTree pairs.
+	__slots__ = ('parent', 'key', '_tree')
+
+	def __init__(self, tree=None, parent=None, key=None):
+		"""Initialize the DataTree, loading existing data if needed. key is the label this DataTree is stored under in its' parent."""
+		# Contains string-to-leaf and string-to-DataTree pairs.
 		self.parent = parent
+		self.key = key
 		self._tree = {} 
 		if tree:
 			for key, value in tree.items():
-				self._tree[str(key)] = self._make_dt_compat(value)
+				self._tree[str(key)] = self._make_dt_compat(value, str(key))
 
-	def _make_dt_compat(self, obj):
-		"""Converts an object to either a DataTree or a string, depending on its' type."""
-		return DataTree(obj, parent=self) if isinstance(obj, dict) else obj if isinstance(obj, DataTree) else str(obj)
+	def _make_dt_compat(self, obj, key):
+		"""Converts an object to be stored under key to either a DataTree or a leaf, depending on its' type. Unsupported types are stored as strings."""
+		if isinstance(obj, DataTree):
+			obj = obj.to_dict()
+		if isinstance(obj, dict):
+			return DataTree(obj, parent=self, key=key)
+		return obj if isinstance(obj, LEAF_TYPES) else str(obj)
 	
 	def __repr__(self):
 		"""Returns a JSON-style representation of the DataTree."""
 		return json.dumps(self.to_dict(), indent=4)
 	
 	def __getitem__(self, key):
-		"""Get the value of DataTree[key]. Creates new parents if they do not exist yet (these do not get written to disk until actual data is changed elsewhere)."""
+		"""Get the value of DataTree[key]. If it does not exist yet, returns a new, empty DataTree which is only stored in this one once something is written to it."""
 		key = str(key)
-		if key not in self._tree:
-			self._tree[key] = DataTree(parent=self)
-		return self._make_dt_compat(self._tree[key])
+		value = self._tree.get(key)
+		if value is None and key not in self._tree:
+			return DataTree(parent=self, key=key)
+		return value
+
+	def get(self, path, default=None):
+		"""Get the value at path (either a single key, or a tuple of keys to follow), or default if it does not exist. Never creates any DataTrees."""
+		if not isinstance(path, tuple):
+			path = (path,)
+		node = self
+		for key in path:
+			if not isinstance(node, DataTree) or key not in node:
+				return default
+			node = node[key]
+		return node
 	
 	def __setitem__(self, key, value):
 		"""Set DataTree[key] = value."""
 		key = str(key)
-		value = self._make_dt_compat(value)
+		self._attach()
+		value = self._make_dt_compat(value, key)
+		old = self._tree.get(key)
 		self._tree[key] = value
-		asyncio.create_task(self._save())
+		self._changed('set', (key,), value, old)
 
 	def __delitem__(self, key):
 		"""Delete DataTree[key]."""
 		key = str(key)
-		del self._tree[key]
-		asyncio.create_task(self._save())
+		old = self._tree.pop(key)
+		self._changed('del', (key,), None, old)
 
 	def __contains__(self, key):
 		"""Check if DataTree[key] exists (current level only)."""
@@ -79,34 +205,567 @@ class DataTree:
 			else:
 				out[key] = value
 		return out
+
+	def scan(self):
+		"""Yields (key, value) for every key at the root of the DataTree, with value as a plain dict or leaf. Meant for reading everything once
+		(e.g. to build an index at startup), so subclasses may read values from storage without keeping them in memory."""
+		for key in list(self._tree):
+			value = self._tree.get(key)
+			yield key, value.to_dict() if isinstance(value, DataTree) else value
 	
+	def _attach(self):
+		"""Stores this DataTree (and any parents it was created with by __getitem__) in its' parent, if it is not stored there already."""
+		if self.parent is not None:
+			self.parent._attach_child(self)
+
+	def _attach_child(self, child):
+		"""Stores child, a DataTree created by __getitem__, under its' key. If another DataTree was stored there in the meantime, child shares its' contents instead.
+		This DataTree is attached first, since doing so may make it share the contents of one which already has something stored under child's key.
+
+		>>> dt = DataTree()
+		>>> v = dt['2']['a']; w = dt['2']['a']
+		>>> v['k'] = 1; w['j'] = 2
+		>>> dt.to_dict()
+		{'2': {'a': {'k': 1, 'j': 2}}}
+		"""
+		self._attach()
+		current = self._tree.get(child.key)
+		if current is child:
+			return
+		if isinstance(current, DataTree):
+			child._tree = current._tree
+		else:
+			self._tree[child.key] = child
+
+	def _changed(self, op, path, value=None, old=None, child=None):
+		"""This does not save to disk and is only implemented to allow for propagation.
+		op is either 'set' or 'del', path is the tuple of keys (relative to this DataTree) that was changed, value and old are its' new and previous values,
+		and child is the sub-DataTree the change propagated from."""
+		if self.parent is not None:
+			self.parent._changed(op, (self.key,) + path, value, old, self)
+
+	def _apply(self, op, path, value=None):
+		"""Applies a change recorded by _changed() to this DataTree without propagating it."""
+		*parent_keys, key = path
+		node = self
+		for parent_key in parent_keys:
+			child = node._tree.get(parent_key)
+			if not isinstance(child, DataTree):
+				if op == 'del':
+					return
+				child = node._tree[parent_key] = DataTree(parent=node, key=parent_key)
+			node = child
+		if op == 'set':
+			node._tree[key] = node._make_dt_compat(value, key)
+		else:
+			node._tree.pop(key, None)
+
+
+class PersistentDataTree(DataTree):
+	"""
+	Base class for DataTrees which are backed by storage. Subclasses implement _load() and _save().
+	All modifications made within save_delay seconds of each other (or within a batch() block) are coalesced into a single _save().
+	"""
+	def __init__(self, save_delay=5):
+		"""Initialize the PersistentDataTree. Subclasses should call _load() once they are ready."""
+		self.parent = None
+		self.key = None
+		self.save_delay = save_delay
+		self._tree = {}
+		self._dirty = False
+		self._batch_depth = 0
+		self._flush_task = None
+		self._save_failures = 0
+		self._save_lock = asyncio.Lock()
+		self._subscriptions = []
+
+	def _load(self):
+		"""Loads data from storage to self._tree."""
+		raise NotImplementedError
+
 	async def _save(self):
-		"""This does not save to disk and is only implemented to allow for propagation."""
-		if self.parent:
-			await self.parent._save()
-		
+		"""Writes changes made since the last _save() to storage."""
+		raise NotImplementedError
+
+	def subscribe(self, pattern, callback):
+		"""Calls callback(op, path, old, new) whenever a value at or above a path matching pattern is set or deleted.
+		pattern is a '/'-separated path where each part may contain wildcards, e.g. '*/birthdays/*'. path is the tuple of keys that was changed,
+		and old and new are its' previous and new values as plain dicts or leaves (None if missing). Callbacks run synchronously, so they should be fast."""
+		self._subscriptions.append((tuple(pattern.split('/')), callback))
+
+	def unsubscribe(self, pattern, callback):
+		"""Stops calling callback for changes matching pattern."""
+		self._subscriptions.remove((tuple(pattern.split('/')), callback))
+
+	def _notify(self, op, path, value, old):
+		"""Calls every subscription whose pattern overlaps path (i.e. either one matches the start of the other).
+		Exceptions raised by callbacks are logged, so that one failing callback does not stop the others (or the change itself)."""
+		plain = None
+		for pattern, callback in list(self._subscriptions):
+			if not all(fnmatchcase(key, part) for key, part in zip(path, pattern)):
+				continue
+			if plain is None:
+				plain = tuple(v.to_dict() if isinstance(v, DataTree) else v for v in (old, value))
+			try:
+				callback(op, path, *plain)
+			except Exception:
+				metrics.incr("subscriber_errors")
+				log.exception("Subscription callback failed", pattern="/".join(pattern), path="/".join(path))
+
+	def _changed(self, op, path, value=None, old=None, child=None):
+		"""Marks the tree as modified and schedules a flush (unless one is already pending or a batch is open), then notifies subscriptions.
+		The change is recorded first, so that it is saved even if a subscription fails."""
+		self._dirty = True
+		if not (self._batch_depth or self._flush_task is not None):
+			self._flush_task = asyncio.create_task(self._delayed_flush())
+		if self._subscriptions:
+			self._notify(op, path, value, old)
+
+	async def _delayed_flush(self, delay=None):
+		"""Waits out the coalescing window (or delay seconds), then flushes every change made during it.
+		If saving fails, the changes are kept and the flush is retried, waiting twice as long after each failure in a row (up to MAX_RETRY_DELAY)."""
+		await asyncio.sleep(self.save_delay if delay is None else delay)
+		self._flush_task = None
+		if self._batch_depth:
+			return
+		try:
+			await self.flush()
+		except Exception:
+			self._save_failures += 1
+			retry = min(max(self.save_delay, 1) * 2 ** self._save_failures, MAX_RETRY_DELAY)
+			metrics.incr("save_failures")
+			log.exception("Failed to save, will retry", failures=self._save_failures, retry_seconds=retry)
+			if self._flush_task is None:
+				self._flush_task = asyncio.create_task(self._delayed_flush(retry))
+
+	@asynccontextmanager
+	async def batch(self):
+		"""Async context manager which defers writing until the outermost batch() block exits, then flushes once.
+		Example: async with bot.dt.batch(): ..."""
+		self._batch_depth += 1
+		try:
+			yield self
+		finally:
+			self._batch_depth -= 1
+			if not self._batch_depth:
+				await self.flush()
+
+	async def flush(self):
+		"""Immediately writes any pending changes to storage. Called on shutdown so that no changes are lost."""
+		if self._flush_task is not None:
+			self._flush_task.cancel()
+			self._flush_task = None
+		async with self._save_lock:
+			if not self._dirty:
+				return
+			self._dirty = False
+			try:
+				with metrics.timer("datatree:save"):
+					await self._save()
+				metrics.incr("saves")
+				self._save_failures = 0
+			except Exception:
+				self._dirty = True
+				raise
+
+	async def close(self):
+		"""Flushes any pending changes and releases the underlying storage."""
+		await self.flush()
+
 
-class SelfWritingDataTree(DataTree):
+class SelfWritingDataTree(PersistentDataTree):
 	"""
-	A DataTree, except it pulls its' data from a file, and every time it is modified, it writes back to that file.
+	A DataTree, except it pulls its' data from a file, and writes back to that file after it is modified.
+
+	If journal is set, each modification is instead appended as a small record to filename + '.journal'. Once the journal grows past
+	compact_size bytes, it is folded back into filename and cleared. On startup, filename is loaded and the journal is replayed on top of it.
+
+	filename is replaced atomically each time it is written, and up to backups old copies of it (at least backup_interval seconds apart) are kept
+	as filename.1, filename.2 and so on, newest first.
 	"""
-	def __init__(self, filename):
+	def __init__(self, filename, save_delay=5, journal=False, compact_size=1048576, backups=0, backup_interval=3600):
 		"""Initialize the SelfWritingDataTree, loading existing data from a file."""
+		super().__init__(save_delay)
 		self.filename = filename
-		self._tree = {}
+		self.backups = backups
+		self.backup_interval = backup_interval
+		self.journal_filename = filename + '.journal'
+		self.journal = journal
+		self.compact_size = compact_size
+		self._pending = []
+		self._journal_size = 0
 		self._load()
 
 	def _load(self):
-		"""Loads JSON data from self.filename to self._tree."""
+		"""Loads JSON data from self.filename to self._tree, then replays the journal (if any) on top of it."""
 		if os.path.exists(self.filename):
 			with open(self.filename, mode='r') as f:
-				dict_tree = json.load(f)
+				dict_tree = upgrade_legacy(json.load(f))
 		else:
 			dict_tree = {}
-		self._tree = DataTree(dict_tree, parent=self)._tree
-		
+		self._tree = {}
+		for key, value in dict_tree.items():
+			self._tree[str(key)] = self._make_dt_compat(value, str(key))
+		self._replay()
+
+	def _replay(self):
+		"""Applies every complete record in self.journal_filename to self._tree.
+		A record torn by a crash mid-write can only be the last one, so it is cut off to keep later appends readable."""
+		if not os.path.exists(self.journal_filename):
+			return
+		good_size = 0
+		with open(self.journal_filename, mode='rb') as f:
+			for line in f:
+				try:
+					if not line.endswith(b'\n'):
+						raise ValueError
+					record = json.loads(line)
+				except ValueError:
+					break
+				self._apply(record['op'], record['path'], record.get('value'))
+				good_size += len(line)
+		if good_size != os.path.getsize(self.journal_filename):
+			os.truncate(self.journal_filename, good_size)
+		self._journal_size = good_size
+		# Journal left behind by journal mode but no longer in use - fold it in on the next save
+		if not self.journal and good_size:
+			self._dirty = True
+
+	def _changed(self, op, path, value=None, old=None, child=None):
+		"""Records the change in the journal (if journaling), then schedules a flush."""
+		if self.journal:
+			record = {'op': op, 'path': list(path)}
+			if op == 'set':
+				record['value'] = value.to_dict() if isinstance(value, DataTree) else value
+			self._pending.append(json.dumps(record) + '\n')
+		super()._changed(op, path, value, old, child)
+
 	async def _save(self):
-		"""Asynchronously saves JSON data from self._tree to self.filename."""
+		"""Appends pending records to the journal if journaling, otherwise (or once the journal is too large) saves a full snapshot."""
+		if self.journal and self._pending:
+			await self._append_journal()
+		if not self.journal or self._journal_size >= self.compact_size:
+			await self._compact()
+
+	async def _append_journal(self):
+		"""Appends all pending records to self.journal_filename, in a worker thread."""
+		records, self._pending = self._pending, []
+		data = ''.join(records).encode()
+		try:
+			await asyncio.to_thread(_append_synced, self.journal_filename, data)
+		except Exception:
+			self._pending = records + self._pending
+			raise
+		self._journal_size += len(data)
+		metrics.incr("bytes_written", len(data))
+
+	async def _compact(self):
+		"""Atomically saves JSON data from self._tree to self.filename, then clears the journal since it is now redundant.
+		A copy of the tree is taken on the event loop, so later changes can't affect it; serializing and writing it happen in a worker thread."""
 		self._prune()
-		async with aiofiles.open(self.filename, mode='w') as f:
-			await f.write(str(self))
+		written = await asyncio.to_thread(write_json_atomic, self.filename, self.to_dict(), self.backups, self.backup_interval)
+		metrics.incr("bytes_written", written)
+		if os.path.exists(self.journal_filename):
+			os.remove(self.journal_filename)
+		self._journal_size = 0
+
+
+class ShardedDataTree(PersistentDataTree):
+	"""
+	A PersistentDataTree which stores each of its' top-level keys (i.e. each guild) in its' own file, dirname/<key>.json.
+	Shards are only read from disk when first accessed, and only shards which were modified are written back.
+	At most max_loaded shards are kept in memory; past that, the least recently used unmodified shards are evicted.
+	"""
+	def __init__(self, dirname, save_delay=5, max_loaded=1000):
+		"""Initialize the ShardedDataTree, listing (but not loading) the shards in dirname."""
+		super().__init__(save_delay)
+		self.dirname = dirname
+		self.max_loaded = max_loaded
+		self._tree = OrderedDict()
+		self._shard_keys = set()
+		# Shards which were deleted, but whose files have not been removed yet by _save()
+		self._deleted_shards = set()
+		self._dirty_shards = set()
+		self._load()
+
+	def _shard_filename(self, key):
+		"""Returns the file that the shard stored under key is saved to."""
+		return os.path.join(self.dirname, quote(key, safe='') + '.json')
+
+	def _load(self):
+		"""Finds all shards in self.dirname. Their contents are loaded lazily by __getitem__."""
+		os.makedirs(self.dirname, exist_ok=True)
+		for filename in os.listdir(self.dirname):
+			if filename.endswith('.json'):
+				self._shard_keys.add(unquote(filename[:-5]))
+
+	def _on_disk(self, key):
+		"""Returns True if the shard stored under key has a file which is still current (i.e. the shard was not deleted since it was last saved)."""
+		return key in self._shard_keys and key not in self._deleted_shards
+
+	def _read_shard(self, key):
+		"""Reads the shard stored under key from disk, without caching it."""
+		filename = self._shard_filename(key)
+		if not os.path.exists(filename):
+			return {}
+		with open(filename, mode='r') as f:
+			return upgrade_legacy(json.load(f))
+
+	def __getitem__(self, key):
+		"""Get the value of DataTree[key], loading it from disk if it is not in memory."""
+		key = str(key)
+		if key in self._tree:
+			self._tree.move_to_end(key)
+			return self._tree[key]
+		if not self._on_disk(key):
+			return DataTree(parent=self, key=key)
+		shard = self._tree[key] = self._make_dt_compat(self._read_shard(key), key)
+		self._evict()
+		return shard
+
+	def _attach_child(self, child):
+		"""Stores child, a new shard created by __getitem__, under its' key.
+		If a shard already exists under that key (in memory or on disk) and child is still empty, child shares the contents of the live shard instead,
+		like DataTree._attach_child() does. Otherwise (e.g. child is a shard which has since been evicted), child is left detached,
+		and changes made to it are replayed on the live shard by _changed()."""
+		if child.key not in self:
+			self._tree[child.key] = child
+			self._evict()
+			return
+		live = self[child.key]
+		if isinstance(live, DataTree) and live is not child and not child._tree:
+			child._tree = live._tree
+
+	def __setitem__(self, key, value):
+		"""Set DataTree[key] = value, whether or not the shard it replaces is in memory."""
+		key = str(key)
+		value = self._make_dt_compat(value, key)
+		old = self._tree.get(key)
+		if old is None and self._on_disk(key) and self._subscriptions:
+			old = self._read_shard(key)
+		self._tree[key] = value
+		self._tree.move_to_end(key)
+		self._changed('set', (key,), value, old)
+		self._evict()
+
+	def __delitem__(self, key):
+		"""Delete DataTree[key], whether or not it is in memory."""
+		key = str(key)
+		if key not in self:
+			raise KeyError(key)
+		old = self._tree.pop(key, None)
+		if old is None and self._subscriptions:
+			old = self._read_shard(key)
+		if key in self._shard_keys:
+			self._deleted_shards.add(key)
+		self._changed('del', (key,), None, old)
+
+	def __contains__(self, key):
+		"""Check if DataTree[key] exists (current level only)."""
+		key = str(key)
+		return key in self._tree or self._on_disk(key)
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def keys(self):
+		"""Returns a list of all keys at the root of the DataTree, including those which are not in memory."""
+		return list((self._shard_keys - self._deleted_shards).union(self._tree))
+
+	def is_empty(self):
+		return not (self._tree or self._shard_keys - self._deleted_shards)
+
+	def to_dict(self):
+		"""Return a dictionary that can be serialized, reading shards which are not in memory directly from disk."""
+		out = {}
+		for key in self.keys():
+			value = self._tree.get(key)
+			if value is None:
+				out[key] = self._read_shard(key)
+			else:
+				out[key] = value.to_dict() if isinstance(value, DataTree) else value
+		return out
+
+	def scan(self):
+		"""Yields (key, value) for every shard, as a plain dict. Shards which are not in memory are read directly from disk, without loading them
+		(so scanning every shard does not evict the ones in use). Since this reads from disk, run it in a worker thread from async code."""
+		for key in self.keys():
+			value = self._tree.get(key)
+			if value is None:
+				yield key, self._read_shard(key)
+			else:
+				yield key, value.to_dict() if isinstance(value, DataTree) else value
+
+	def _evict(self):
+		"""Evicts the least recently used unmodified shards until at most self.max_loaded remain in memory."""
+		excess = len(self._tree) - self.max_loaded
+		if excess <= 0:
+			return
+		# The most recently used shard is never evicted, since it is about to be used
+		for key in list(self._tree)[:-1]:
+			if excess <= 0:
+				break
+			if key not in self._dirty_shards:
+				del self._tree[key]
+				excess -= 1
+
+	def _changed(self, op, path, value=None, old=None, child=None):
+		"""Marks the shard that path belongs to as modified, then schedules a flush.
+		If the change was made through a reference to a shard which has since been evicted, it is also applied to the live copy
+		(and subscribers are given the live copy's previous value, since the evicted one may be out of date)."""
+		key = path[0]
+		live = self._tree.get(key)
+		if child is not None and live is not child and not (isinstance(live, DataTree) and live._tree is child._tree):
+			shard = self[key]
+			shard._attach()
+			if self._subscriptions:
+				old = shard.get(path[1:])
+			shard._apply(op, path[1:], value)
+		self._dirty_shards.add(key)
+		super()._changed(op, path, value, old, child)
+
+	async def _save(self):
+		"""Atomically writes every modified shard to its' file (in a worker thread), deleting the files of shards which were removed or left empty."""
+		dirty_shards, self._dirty_shards = self._dirty_shards, set()
+		try:
+			for key in dirty_shards:
+				filename = self._shard_filename(key)
+				shard = self._tree.get(key)
+				if isinstance(shard, DataTree):
+					shard._prune()
+				if shard is None or (isinstance(shard, DataTree) and shard.is_empty()):
+					self._shard_keys.discard(key)
+					if os.path.exists(filename):
+						os.remove(filename)
+					self._deleted_shards.discard(key)
+					continue
+				data = shard.to_dict() if isinstance(shard, DataTree) else shard
+				metrics.incr("bytes_written", await asyncio.to_thread(write_json_atomic, filename, data))
+				self._shard_keys.add(key)
+				# Unless the shard was deleted again while it was being written
+				if key not in self._dirty_shards:
+					self._deleted_shards.discard(key)
+		except Exception:
+			self._dirty_shards |= dirty_shards
+			raise
+		self._evict()
+
+
+class SQLiteDataTree(PersistentDataTree):
+	"""
+	A PersistentDataTree which stores each value as a row in a SQLite database, keyed by its' path.
+	The whole tree is kept in memory for reads, but changes are written to the database as row-level upserts and deletes,
+	so changing one value (such as a usage counter) only touches that value's row. Database work runs in a worker thread.
+	"""
+	def __init__(self, filename, save_delay=5):
+		"""Initialize the SQLiteDataTree, creating the database if needed and loading existing data from it."""
+		super().__init__(save_delay)
+		self.filename = filename
+		self._pending = {}
+		self._db = sqlite3.connect(filename, check_same_thread=False)
+		self._db.execute('PRAGMA journal_mode=WAL')
+		self._db.execute('PRAGMA synchronous=NORMAL')
+		self._db.execute('CREATE TABLE IF NOT EXISTS data (path TEXT PRIMARY KEY, value TEXT NOT NULL)')
+		self._db.commit()
+		self._load()
+
+	@staticmethod
+	def _encode_path(path):
+		"""Returns the row key for path. Paths are stored as compact JSON arrays, so all descendants of a path share a prefix."""
+		return json.dumps(list(path), separators=(',', ':'))
+
+	@staticmethod
+	def _descendant_range(encoded):
+		"""Returns (low, high) such that low <= key < high for exactly the row keys of all descendants of an encoded path."""
+		prefix = encoded[:-1] + ','
+		return prefix, encoded[:-1] + '-'
+
+	@staticmethod
+	def _flatten(path, value):
+		"""Yields (path, value) for every leaf of value, which is stored at path."""
+		if isinstance(value, dict):
+			for key, child in value.items():
+				yield from SQLiteDataTree._flatten(path + (str(key),), child)
+		else:
+			yield path, value
+
+	def _load(self):
+		"""Loads every row of the database to self._tree."""
+		self._tree = {}
+		for encoded, value in self._db.execute('SELECT path, value FROM data'):
+			self._apply('set', json.loads(encoded), json.loads(value))
+
+	@classmethod
+	def from_json(cls, json_filename, filename, save_delay=5):
+		"""Creates the database filename from the JSON data in json_filename (such as an old data.json), and returns the SQLiteDataTree for it.
+		The database is built under a temporary name and only renamed to filename once the import has committed,
+		so if the import fails or is interrupted, filename is never left behind half-migrated (or empty), and the migration is retried next time."""
+		temp = filename + '.migrating'
+		for stale in (temp, temp + '-wal', temp + '-shm'):
+			if os.path.exists(stale):
+				os.remove(stale)
+		dt = cls(temp, save_delay)
+		try:
+			dt.import_json(json_filename)
+			# Leave WAL mode, so that everything is checkpointed into the database file itself before it is renamed
+			dt._db.execute('PRAGMA journal_mode=DELETE')
+		finally:
+			dt._db.close()
+		os.replace(temp, filename)
+		return cls(filename, save_delay)
+
+	def import_json(self, filename):
+		"""One-shot migration: replaces the contents of the database (and this tree) with the JSON data in filename, such as an old data.json."""
+		with open(filename, mode='r') as f:
+			dict_tree = upgrade_legacy(json.load(f))
+		rows = [(self._encode_path(path), json.dumps(value)) for path, value in self._flatten((), dict_tree)]
+		with self._db:
+			self._db.execute('DELETE FROM data')
+			self._db.executemany('INSERT INTO data (path, value) VALUES (?, ?)', rows)
+		self._load()
+
+	def _changed(self, op, path, value=None, old=None, child=None):
+		"""Queues the change to be written to the database, then schedules a flush.
+		Only the latest change to each path is kept, since it replaces everything earlier changes to that path (or below it) did."""
+		if isinstance(value, DataTree):
+			value = value.to_dict()
+		self._pending.pop(path, None)
+		self._pending[path] = (op, value)
+		super()._changed(op, path, value, old, child)
+
+	async def _save(self):
+		"""Writes all queued changes to the database in a single transaction, in a worker thread."""
+		pending, self._pending = self._pending, {}
+		try:
+			written = await asyncio.to_thread(self._write, pending)
+		except Exception:
+			pending.update(self._pending)
+			self._pending = pending
+			raise
+		metrics.incr("bytes_written", written)
+
+	def _write(self, pending):
+		"""Applies queued changes to the database. Run in a worker thread by _save(). Returns the number of bytes of values written."""
+		written = 0
+		with self._db:
+			for path, (op, value) in pending.items():
+				encoded = self._encode_path(path)
+				self._db.execute('DELETE FROM data WHERE path >= ? AND path < ?', self._descendant_range(encoded))
+				if op == 'del' or isinstance(value, dict):
+					self._db.execute('DELETE FROM data WHERE path = ?', (encoded,))
+				if op == 'del':
+					continue
+				if isinstance(value, dict):
+					rows = [(self._encode_path(leaf_path), json.dumps(leaf)) for leaf_path, leaf in self._flatten(path, value)]
+					self._db.executemany('INSERT INTO data (path, value) VALUES (?, ?)', rows)
+					written += sum(len(row[0]) + len(row[1]) for row in rows)
+				else:
+					row = (encoded, json.dumps(value))
+					self._db.execute('INSERT INTO data (path, value) VALUES (?, ?) ON CONFLICT(path) DO UPDATE SET value = excluded.value', row)
+					written += len(row[0]) + len(row[1])
+		return written
+
+	async def close(self):
+		"""Flushes any pending changes and closes the database."""
+		await super().close()
+		self._db.close()
@@ -0,0 +1,177 @@
+"""
+diagnostics.py
+Opt-in tools for finding out what is slowing the bot down, while it is running (enabled with DIAGNOSTICS in tb3k.py).
+
+LoopMonitor measures how late the event loop runs a heartbeat (its' lag), and logs the stack of whatever is blocking the loop for longer than a threshold.
+SamplingProfiler periodically records the stack of the event loop's thread, and writes how often each stack was seen in collapsed format
+(one "outer;inner;innermost count" line per stack), which can be read by flamegraph.pl, speedscope and similar tools.
+Diagnostics ties them together, and lets profiles be started by a signal (SIGUSR1) as well as by the owner-only /profile command.
+"""
+
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from metrics import get_logger, metrics
+
+
+log = get_logger("diagnostics")
+
+
+def _collapse(frame):
+	"""Returns the stack ending at frame as a collapsed stack: a ';'-separated list of functions, outermost first."""
+	names = []
+	while frame is not None:
+		code = frame.f_code
+		names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+		frame = frame.f_back
+	return ";".join(reversed(names))
+
+
+class LoopMonitor:
+	"""
+	Runs a heartbeat on the event loop every interval seconds, recording how late it runs in the 'event_loop:lag' histogram.
+	A watchdog thread logs the event loop thread's stack whenever the heartbeat is more than threshold seconds late, i.e. while the loop is blocked.
+	"""
+	def __init__(self, interval=0.1, threshold=0.25):
+		self.interval = interval
+		self.threshold = threshold
+		self._task = None
+		self._watchdog = None
+		self._stopped = threading.Event()
+		self._last_beat = time.monotonic()
+		self._reported = False
+
+	def start(self):
+		"""Starts monitoring the running event loop. Must be called from within it."""
+		self._loop_thread_id = threading.get_ident()
+		self._last_beat = time.monotonic()
+		self._stopped.clear()
+		self._task = asyncio.create_task(self._heartbeat())
+		self._watchdog = threading.Thread(target=self._watch, name="tb3k-loop-watchdog", daemon=True)
+		self._watchdog.start()
+
+	def stop(self):
+		"""Stops monitoring."""
+		self._stopped.set()
+		if self._task is not None:
+			self._task.cancel()
+			self._task = None
+
+	async def _heartbeat(self):
+		while True:
+			start = time.perf_counter()
+			await asyncio.sleep(self.interval)
+			lag = time.perf_counter() - start - self.interval
+			metrics.observe("event_loop:lag", lag)
+			if lag > self.threshold:
+				metrics.incr("event_loop_blocks")
+				log.warning("Event loop was blocked", seconds=round(lag, 3))
+			self._last_beat = time.monotonic()
+			self._reported = False
+
+	def _watch(self):
+		"""Watchdog thread: logs the event loop thread's stack (once per block) while the heartbeat is late."""
+		while not self._stopped.wait(self.interval):
+			late = time.monotonic() - self._last_beat - self.interval
+			if late <= self.threshold or self._reported:
+				continue
+			frame = sys._current_frames().get(self._loop_thread_id)
+			if frame is None:
+				continue
+			self._reported = True
+			stack = "".join(traceback.format_stack(frame)).rstrip()
+			log.warning(f"Event loop is blocked, while running:\n{stack}", seconds=round(late, 3))
+
+
+class SamplingProfiler:
+	"""
+	Records the stack of one thread every interval seconds, from a background thread, until stopped.
+	"""
+	def __init__(self, thread_id, interval=0.005):
+		self.thread_id = thread_id
+		self.interval = interval
+		self.stacks = Counter()
+		self.samples = 0
+		self._stopped = threading.Event()
+		self._thread = None
+
+	def start(self):
+		self._thread = threading.Thread(target=self._sample, name="tb3k-profiler", daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		"""Stops sampling, and waits for the sampling thread to finish."""
+		self._stopped.set()
+		self._thread.join()
+
+	def _sample(self):
+		while not self._stopped.wait(self.interval):
+			frame = sys._current_frames().get(self.thread_id)
+			if frame is not None:
+				self.stacks[_collapse(frame)] += 1
+				self.samples += 1
+
+	def write(self, filename):
+		"""Writes the recorded stacks to filename in collapsed format, most frequent first."""
+		with open(filename, mode='w') as f:
+			for stack, count in self.stacks.most_common():
+				f.write(f"{stack} {count}\n")
+
+
+class Diagnostics:
+	"""
+	The event loop monitor and on-demand profiler of a running bot. Profiles are written to profile_dir.
+	"""
+	def __init__(self, lag_threshold=0.25, profile_dir='profiles', profile_interval=0.005):
+		self.monitor = LoopMonitor(threshold=lag_threshold)
+		self.profile_dir = profile_dir
+		self.profile_interval = profile_interval
+		self.profiling = False
+
+	def start(self, profile_signal_seconds=30):
+		"""Starts monitoring the running event loop, and starts a profile_signal_seconds profile whenever the process receives SIGUSR1 (where supported)."""
+		self._loop_thread_id = threading.get_ident()
+		self.monitor.start()
+		try:
+			asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self._on_signal, profile_signal_seconds)
+		except (AttributeError, NotImplementedError, RuntimeError):
+			log.info("Profiling on SIGUSR1 is not supported on this platform")
+
+	def stop(self):
+		self.monitor.stop()
+		try:
+			asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+		except (AttributeError, NotImplementedError, RuntimeError):
+			pass
+
+	def _on_signal(self, seconds):
+		if not self.profiling:
+			asyncio.create_task(self.profile(seconds))
+
+	async def profile(self, seconds):
+		"""Profiles the event loop for seconds seconds, and writes the result to a new file in profile_dir. Returns the file's name.
+		Raises RuntimeError if a profile is already being taken."""
+		if self.profiling:
+			raise RuntimeError("A profile is already being taken")
+		self.profiling = True
+		try:
+			log.info("Started profiling", seconds=seconds)
+			profiler = SamplingProfiler(self._loop_thread_id, self.profile_interval)
+			profiler.start()
+			try:
+				await asyncio.sleep(seconds)
+			finally:
+				await asyncio.to_thread(profiler.stop)
+			os.makedirs(self.profile_dir, exist_ok=True)
+			filename = os.path.join(self.profile_dir, time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+			await asyncio.to_thread(profiler.write, filename)
+			log.info("Wrote profile", filename=filename, samples=profiler.samples)
+			return filename
+		finally:
+			self.profiling = False
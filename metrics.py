@@ -0,0 +1,175 @@
+"""
+metrics.py
+Shared instrumentation for tb3k: logging which never blocks the event loop, and in-memory counters and latency histograms.
+
+Log records are put on a queue and written out by a background thread (see setup_logging()). get_logger() returns loggers which take
+structured fields as keyword arguments, e.g. log.info("Ran command /say", user=name, message=message).
+
+Counters and histograms are kept in the shared Metrics instance, metrics, and can be read with metrics.snapshot() (e.g. by the /stats command).
+"""
+
+import bisect
+import functools
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from contextlib import contextmanager
+
+
+LOG_FORMAT = "%(asctime)s %(levelname)-8s [%(name)s] %(message)s"
+# Upper bounds (in seconds) of the buckets latencies are counted in
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+_listener = None
+
+
+class StructuredFormatter(logging.Formatter):
+	"""
+	Formats log records, appending the structured fields given to a StructuredLogger as key=value pairs (to the first line, if the message has several).
+	"""
+	def formatMessage(self, record):
+		out = super().formatMessage(record)
+		fields = getattr(record, 'fields', None)
+		if fields:
+			first, newline, rest = out.partition("\n")
+			out = first + " " + " ".join(f"{key}={value!r}" if isinstance(value, str) else f"{key}={value}" for key, value in fields.items()) + newline + rest
+		return out
+
+
+class StructuredLogger(logging.LoggerAdapter):
+	"""
+	Logger which takes structured fields as keyword arguments. EXAMPLE: log.info("Sent message", channel=channel.id, attempt=2).
+	"""
+	def __init__(self, logger):
+		super().__init__(logger, {})
+
+	def process(self, msg, kwargs):
+		standard = {key: kwargs.pop(key) for key in ('exc_info', 'stack_info', 'stacklevel', 'extra') if key in kwargs}
+		standard.setdefault('extra', {})['fields'] = kwargs
+		return msg, standard
+
+
+def get_logger(name):
+	"""Returns the StructuredLogger for a part of tb3k, e.g. get_logger('birthday')."""
+	return StructuredLogger(logging.getLogger(f"tb3k.{name}"))
+
+
+def setup_logging(level=logging.INFO, handler=None):
+	"""Sends all log records (tb3k's and discord.py's) through a queue to handler (by default, one which writes to stderr), from a background thread,
+	so that logging never waits on I/O. Call stop_logging() on shutdown to write out any records still queued."""
+	global _listener
+	if _listener is not None:
+		return
+	if handler is None:
+		handler = logging.StreamHandler(sys.stderr)
+	# Records are formatted as they are queued (which is cheap), so only writing them out happens in the background
+	handler.setFormatter(logging.Formatter("%(message)s"))
+	log_queue = queue.SimpleQueue()
+	queue_handler = logging.handlers.QueueHandler(log_queue)
+	queue_handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+	root = logging.getLogger()
+	root.addHandler(queue_handler)
+	root.setLevel(level)
+	_listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+	_listener.start()
+
+
+def stop_logging():
+	"""Writes out every queued log record and stops the background thread started by setup_logging()."""
+	global _listener
+	if _listener is not None:
+		_listener.stop()
+		_listener = None
+
+
+class Histogram:
+	"""
+	Counts latencies in the buckets given by LATENCY_BUCKETS. Quantiles are estimated as the upper bound of the bucket they fall in.
+	"""
+	def __init__(self):
+		self.buckets = [0] * len(LATENCY_BUCKETS)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def observe(self, seconds):
+		"""Records one latency, in seconds."""
+		self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def quantile(self, q):
+		"""Returns an upper bound (in seconds) on the q-quantile of the recorded latencies (at most the largest one), e.g. quantile(0.99) for p99."""
+		target = q * self.count
+		seen = 0
+		for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+			seen += count
+			if seen >= target:
+				return min(bound, self.max)
+		return self.max
+
+	def summary(self):
+		"""Returns a dict of the number of latencies recorded and their mean, p50, p99 and max, in milliseconds."""
+		return {
+			'count': self.count,
+			'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+			'p50_ms': self.quantile(0.5) * 1000,
+			'p99_ms': self.quantile(0.99) * 1000,
+			'max_ms': self.max * 1000,
+		}
+
+
+class Metrics:
+	"""
+	Named counters and latency histograms, kept in memory since startup.
+	"""
+	def __init__(self):
+		self.started = time.time()
+		self.counters = {}
+		self.histograms = {}
+
+	def incr(self, name, n=1):
+		"""Adds n to the counter name."""
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	def observe(self, name, seconds):
+		"""Records a latency (in seconds) in the histogram name."""
+		histogram = self.histograms.get(name)
+		if histogram is None:
+			histogram = self.histograms[name] = Histogram()
+		histogram.observe(seconds)
+
+	@contextmanager
+	def timer(self, name):
+		"""Context manager which records how long its' block took in the histogram name."""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start)
+
+	def timed(self, name):
+		"""Decorator for coroutine functions (e.g. command handlers and listeners) which records how long each call took in the histogram name.
+		Place it directly above the function, below any discord.py decorators."""
+		def decorator(func):
+			@functools.wraps(func)
+			async def wrapper(*args, **kwargs):
+				with self.timer(name):
+					return await func(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	def snapshot(self):
+		"""Returns the current value of every counter and a summary of every histogram, as a dict."""
+		return {
+			'uptime': time.time() - self.started,
+			'counters': dict(sorted(self.counters.items())),
+			'latencies': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+		}
+
+
+metrics = Metrics()
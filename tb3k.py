@@ -3,6 +3,10 @@ tb3k.py
 Main discord bot file. Run this to launch the bot. Does not return anything, but will output a debug console to the terminal.
 """
 
+import asyncio
+import hashlib
+import json
+import logging
 import os
 
 import discord
@@ -10,15 +14,47 @@ from discord.ext import commands
 
 from dotenv import load_dotenv
 
-from datatree import SelfWritingDataTree as dt
+from datatree import SelfWritingDataTree, ShardedDataTree, SQLiteDataTree
+from diagnostics import Diagnostics
+from metrics import get_logger, setup_logging, stop_logging
+
+
+# CONFIGURATION
+# Where bot state is stored. 'json' keeps everything in data.json; 'sharded' keeps one file per server in data/, loading servers as they are used;
+# 'sqlite' keeps one row per value in data.db (if data.db does not exist yet, it is created from data.json)
+STORAGE = 'json'
+# Seconds to wait after a change before writing it to storage, so that bursts of changes are coalesced into one write
+SAVE_DELAY = 5
+# If True, changes are appended to data.json.journal instead of rewriting all of data.json, which is only rewritten once the journal passes JOURNAL_COMPACT_SIZE bytes
+JOURNAL = False
+JOURNAL_COMPACT_SIZE = 1048576
+# Number of old copies of data.json to keep (as data.json.1, data.json.2...), and the minimum number of seconds between them
+BACKUPS = 5
+BACKUP_INTERVAL = 3600
+# Maximum number of servers kept in memory when using 'sharded' storage
+SHARDED_MAX_LOADED = 1000
+# If True, every member of every server is kept in memory. If False, members are only looked up when needed, which uses far less memory in large servers
+MEMBER_CACHE = False
+# Minimum level of log messages to show ('DEBUG' also shows every auto-response and birthday sent)
+LOG_LEVEL = 'INFO'
+# If True, logs whenever something blocks the bot for longer than LAG_THRESHOLD seconds (with what it was doing), and allows the bot to be profiled
+# with /profile or by sending it SIGUSR1 (which profiles it for PROFILE_SECONDS seconds). Profiles are saved in PROFILE_DIR
+DIAGNOSTICS = False
+LAG_THRESHOLD = 0.25
+PROFILE_SECONDS = 30
+PROFILE_DIR = 'profiles'
+# Where the hash of the last command tree synced with Discord is kept; the command tree is only synced again when it changes
+COMMAND_HASH_FILE = '.command_tree_hash'
 
 
 # INITIALIZATION
+log = get_logger("core")
+
 # Load auth token
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 if TOKEN is None:
-	print("[ERROR] It looks like you didn't set DISCORD_TOKEN in .env. Please get an API key from discord.dev and try again.")
+	log.error("It looks like you didn't set DISCORD_TOKEN in .env. Please get an API key from discord.dev and try again.")
 
 # Define intents needed
 intents = discord.Intents.default()
@@ -26,35 +62,105 @@ intents.messages = True
 intents.members = True
 intents.message_content = True
 intents.guilds = True
+# Keep every member of every server in memory? If not, members are looked up only when needed (e.g. for birthday announcements)
+member_cache_flags = discord.MemberCacheFlags.from_intents(intents) if MEMBER_CACHE else discord.MemberCacheFlags.none()
+
+
+# Load storage (data.json, data/ or data.db)
+def load_storage():
+	"""Returns the DataTree configured by STORAGE. Run in a worker thread, since it reads all of storage."""
+	if STORAGE == 'sharded':
+		log.info("Loading data/...")
+		return ShardedDataTree('data', save_delay=SAVE_DELAY, max_loaded=SHARDED_MAX_LOADED)
+	elif STORAGE == 'sqlite':
+		if not os.path.exists('data.db') and os.path.exists('data.json'):
+			log.info("Migrating data.json to data.db...")
+			return SQLiteDataTree.from_json('data.json', 'data.db', save_delay=SAVE_DELAY)
+		log.info("Loading data.db...")
+		return SQLiteDataTree('data.db', save_delay=SAVE_DELAY)
+	else:
+		log.info("Loading data.json...")
+		return SelfWritingDataTree('data.json', save_delay=SAVE_DELAY, journal=JOURNAL, compact_size=JOURNAL_COMPACT_SIZE, backups=BACKUPS, backup_interval=BACKUP_INTERVAL)
+
 
 # Define bot
-bot = commands.Bot(command_prefix='/', intents=intents)
+class TB3K(commands.Bot):
+	diagnostics = None
 
+	async def login(self, token):
+		"""Logs in to Discord, loading storage in a worker thread at the same time."""
+		self.storage_task = asyncio.create_task(asyncio.to_thread(load_storage))
+		await super().login(token)
 
-# ON READY
-# Load data.json, cogs, sync command tree, update rich presence
-@bot.event
-async def on_ready():
-	# Load data.json
-	print("[core] Loading data.json...")
-	bot.dt = dt('data.json')
+	async def setup_hook(self):
+		"""Runs once, after logging in and before connecting to Discord: starts diagnostics (if enabled), waits for storage, loads cogs, and syncs the command tree."""
+		if DIAGNOSTICS:
+			log.info("Starting diagnostics...")
+			self.diagnostics = Diagnostics(lag_threshold=LAG_THRESHOLD, profile_dir=PROFILE_DIR)
+			self.diagnostics.start(profile_signal_seconds=PROFILE_SECONDS)
+
+		self.dt = await self.storage_task
 
-	# Load cogs
-	print("[core] Loading cogs...")
-	await bot.load_extension('cogs.auto-responses')
-	await bot.load_extension('cogs.birthday')
-	await bot.load_extension('cogs.say')
+		# Load cogs
+		log.info("Loading cogs...")
+		await self.load_extension('cogs.auto-responses')
+		await self.load_extension('cogs.birthday')
+		await self.load_extension('cogs.say')
+		await self.load_extension('cogs.stats')
 
-	# Sync command tree
-	print("[core] Syncing command tree...")
-	await bot.tree.sync()
+		await self.sync_command_tree()
 
+	def command_tree_hash(self):
+		"""Returns a hash of the commands in the command tree (as they would be sent to Discord), and the application they belong to."""
+		schema = [command.to_dict(self.tree) for command in self.tree.get_commands()]
+		data = json.dumps([self.application_id, schema], sort_keys=True)
+		return hashlib.sha256(data.encode()).hexdigest()
+
+	async def sync_command_tree(self):
+		"""Syncs the command tree with Discord, unless it hasn't changed since the last time it was synced."""
+		tree_hash = self.command_tree_hash()
+		try:
+			with open(COMMAND_HASH_FILE, mode='r') as f:
+				synced_hash = f.read().strip()
+		except FileNotFoundError:
+			synced_hash = None
+		if tree_hash == synced_hash:
+			log.info("Command tree unchanged since the last sync, not syncing it")
+			return
+
+		log.info("Syncing command tree...")
+		await self.tree.sync()
+		with open(COMMAND_HASH_FILE, mode='w') as f:
+			f.write(tree_hash)
+
+	async def close(self):
+		"""Shuts down the bot, then writes any changes to storage that have not been flushed yet."""
+		if self.diagnostics is not None:
+			self.diagnostics.stop()
+		await super().close()
+		if hasattr(self, 'dt'):
+			log.info("Flushing unsaved data...")
+			await self.dt.close()
+
+bot = TB3K(command_prefix='/', intents=intents, member_cache_flags=member_cache_flags, chunk_guilds_at_startup=MEMBER_CACHE)
+
+
+# ON READY
+# Update rich presence. Runs again whenever the bot reconnects, so everything that should only happen once is in TB3K.setup_hook()
+@bot.event
+async def on_ready():
 	# Update rich presence
-	print("[core] Updating rich presence...")
+	log.info("Updating rich presence...")
 	await bot.change_presence(activity=discord.Streaming(name='something...', url='https://www.youtube.com/watch?v=E4WlUXrJgy4'))
 	
-	print(f'[core] Ready to go! Logged in as {bot.user}.')
+	log.info(f"Ready to go! Logged in as {bot.user}.")
 
 
 # LAUNCH TB3K
-bot.run(TOKEN)
\ No newline at end of file
+# (Guarded, since worker processes started by cogs re-import this file)
+if __name__ == '__main__':
+	setup_logging(getattr(logging, LOG_LEVEL))
+	try:
+		bot.run(TOKEN, log_handler=None)
+	finally:
+		stop_logging()